@@ -1,5 +1,11 @@
 import array
 import copy
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import platform
 import socket
 import struct
 
@@ -8,6 +14,20 @@ class SerializeError(Exception):
   """Failed to serialize data."""
 
 
+class ParseError(Exception):
+  """Failed to parse data."""
+
+
+_FLAGS_AND_LENGTH = struct.Struct('!H')
+# flags and length followed by a vector of each type
+_VECTORS = dict([(vector_type, struct.Struct('!H' + vector_type))
+                 for vector_type in 'BHI'])
+_VECTOR_FIELDS = dict([(vector_type, struct.Struct('!' + vector_type))
+                       for vector_type in 'BHI'])
+# a PDU flag that only parsing supports, for a 20-bit length in 3 bytes
+_FLAG_LENGTH = 8
+
+
 class PDU(object):
   _FLAG_VECTOR = 4
   _FLAG_HEADER = 2
@@ -27,48 +47,180 @@ class PDU(object):
     self._header = header
 
   def SetData(self, data):
+    """Sets the data to a string or buffer, or to a PDU or PDUBlock.
+
+    A PDU or PDUBlock is the layer below, and is serialized in place as the
+    data, so a packet of several layers is written in one pass.
+    """
     self._data = data
 
+  def Size(self, last_pdu=None):
+    """Returns the number of bytes the PDU takes when it follows last_pdu."""
+    return self._Layout(last_pdu)[1]
+
   def Serialize(self, last_pdu=None):
+    flags, length = self._Layout(last_pdu)
+    if length >= 4096:
+      raise SerializeError('PDU too large: %d bytes' % length)
     p = array.array('B')
-    flags = 0
 
-    # placeholder for flags, LengthH and LengthL (LengthX not supported)
-    p.fromstring(struct.pack('!xx'))
+    # flags, LengthH and LengthL (LengthX not supported), then the vector
+    flags_and_length = (flags << 12) | length
+    if flags & PDU._FLAG_VECTOR:
+      p.fromstring(_VECTORS[self._vector_type].pack(flags_and_length,
+                                                    self._vector))
+    else:
+      p.fromstring(_FLAGS_AND_LENGTH.pack(flags_and_length))
+    if flags & PDU._FLAG_HEADER:
+      p.fromstring(self._header)
+    if flags & PDU._FLAG_DATA:
+      if isinstance(self._data, _LAYERS):
+        p.extend(self._data.Serialize())
+      else:
+        p.fromstring(self._data)
+    return p
+
+  def SerializeInto(self, buf, offset=0, last_pdu=None):
+    """Writes the PDU into buf at offset and returns the offset past it.
 
+    buf is a bytearray or a writable memoryview with room for
+    Size(last_pdu) bytes. The vector, header and data that equal those of
+    last_pdu are left out, as in a PDU block.
+
+    The layers below are written first and the length is filled in after
+    them, so each layer is walked once. If buf turns out to be too small,
+    SerializeError is raised and buf is left partly written.
+    """
+    flags = self._Flags(last_pdu)
+    if not isinstance(buf, memoryview):
+      # slice stores into a memoryview are much cheaper
+      buf = memoryview(buf)
+    size = len(buf)
+
+    # flags, LengthH and LengthL (LengthX not supported), then the vector
+    if flags & PDU._FLAG_VECTOR:
+      fields = _VECTORS[self._vector_type]
+    else:
+      fields = _FLAGS_AND_LENGTH
+    position = offset + fields.size
+    if flags & PDU._FLAG_HEADER:
+      header = self._header
+      if isinstance(header, array.array):
+        # arrays lack the buffer interface that memoryview stores need
+        header = header.tostring()
+      end = position + len(header)
+      if end > size:
+        raise SerializeError('PDU does not fit at offset %d' % offset)
+      buf[position:end] = header
+      position = end
+    if flags & PDU._FLAG_DATA:
+      data = self._data
+      if isinstance(data, _LAYERS):
+        position = data.SerializeInto(buf, position)
+      else:
+        if isinstance(data, array.array):
+          data = data.tostring()
+        end = position + len(data)
+        if end > size:
+          raise SerializeError('PDU does not fit at offset %d' % offset)
+        buf[position:end] = data
+        position = end
+    elif position > size:
+      raise SerializeError('PDU does not fit at offset %d' % offset)
+
+    length = position - offset
+    if length >= 4096:
+      raise SerializeError('PDU too large: %d bytes' % length)
+    if flags & PDU._FLAG_VECTOR:
+      fields.pack_into(buf, offset, (flags << 12) | length, self._vector)
+    else:
+      fields.pack_into(buf, offset, (flags << 12) | length)
+    return position
+
+  def _Flags(self, last_pdu):
+    """Returns the flags that tell which of the vector, header and data are
+    emitted when the PDU follows last_pdu.
+    """
     if last_pdu:
       if self._vector_type != last_pdu._vector_type:
         raise SerializeError('Different vector lengths in same PDU block')
-    if last_pdu and self._vector == last_pdu._vector:
-      # don't emit vector
-      pass
-    else:
+    flags = 0
+    if not (last_pdu and self._vector == last_pdu._vector):
       flags |= PDU._FLAG_VECTOR
-      p.fromstring(struct.pack('!' + self._vector_type, self._vector))
+    if self._header and not (last_pdu and self._header == last_pdu._header):
+      flags |= PDU._FLAG_HEADER
+    if self._data and not (last_pdu and self._data == last_pdu._data):
+      flags |= PDU._FLAG_DATA
+    return flags
 
-    if self._header:
-      if last_pdu and self._header == last_pdu._header:
-        # don't emit header
-        pass
+  def _Layout(self, last_pdu):
+    """Returns the flags and length of the PDU when it follows last_pdu."""
+    flags = self._Flags(last_pdu)
+    if flags & PDU._FLAG_VECTOR:
+      length = _VECTORS[self._vector_type].size
+    else:
+      length = _FLAGS_AND_LENGTH.size
+    if flags & PDU._FLAG_HEADER:
+      length += len(self._header)
+    if flags & PDU._FLAG_DATA:
+      if isinstance(self._data, _LAYERS):
+        length += self._data.Size()
       else:
-        flags |= PDU._FLAG_HEADER
-        p.fromstring(self._header)
+        length += len(self._data)
+    return flags, length
 
-    if self._data:
-      if last_pdu and self._data == last_pdu._data:
-        # don't emit data
-        pass
-      else:
-        flags |= PDU._FLAG_DATA
-        p.fromstring(self._data)
 
-    if len(p) >= 4096:
-      raise SerializeError('PDU too large: %d bytes' % len(p))
-    p[0] = (flags << 4) | (len(p) >> 8)
-    p[1] = len(p) & 0xFF
+class PDUBlock(object):
+  """PDUs that follow each other, to be the data of a PDU of the layer above.
+
+  Like in a RootLayerPacket, each PDU leaves out the vector, header and data
+  that equal those of the PDU before it.
+  """
+
+  def __init__(self):
+    self._pdu_block = []
 
+  def AddPDU(self, pdu):
+    self._pdu_block.append(pdu)
+
+  def Size(self):
+    return _BlockSize(self._pdu_block)
+
+  def Serialize(self):
+    p = array.array('B')
+    last_pdu = None
+    for pdu in self._pdu_block:
+      p.extend(pdu.Serialize(last_pdu=last_pdu))
+      last_pdu = pdu
     return p
 
+  def SerializeInto(self, buf, offset=0):
+    """Writes the block into buf at offset and returns the offset past it."""
+    if not isinstance(buf, memoryview):
+      buf = memoryview(buf)
+    return _SerializeBlockInto(self._pdu_block, buf, offset)
+
+
+# what a PDU's data can be besides a string or buffer
+_LAYERS = (PDU, PDUBlock)
+
+
+def _BlockSize(pdus):
+  size = 0
+  last_pdu = None
+  for pdu in pdus:
+    size += pdu.Size(last_pdu=last_pdu)
+    last_pdu = pdu
+  return size
+
+
+def _SerializeBlockInto(pdus, buf, offset):
+  last_pdu = None
+  for pdu in pdus:
+    offset = pdu.SerializeInto(buf, offset, last_pdu=last_pdu)
+    last_pdu = pdu
+  return offset
+
 
 class RootLayerPacket(object):
   _PREAMBLE = struct.pack('!HH12s', 16, 0, 'ASC-E1.17')
@@ -79,6 +231,9 @@ class RootLayerPacket(object):
   def AddPDU(self, pdu):
     self._pdu_block.append(pdu)
 
+  def Size(self):
+    return len(RootLayerPacket._PREAMBLE) + _BlockSize(self._pdu_block)
+
   def Serialize(self):
     p = array.array('B')
     p.fromstring(RootLayerPacket._PREAMBLE)
@@ -88,16 +243,332 @@ class RootLayerPacket(object):
       last_pdu = pdu
     return p
 
+  def SerializeInto(self, buf, offset=0):
+    """Writes the packet into buf at offset and returns the offset past it.
+
+    buf is a bytearray or a writable memoryview with room for Size() bytes.
+    """
+    end = offset + len(RootLayerPacket._PREAMBLE)
+    if end > len(buf):
+      raise SerializeError('Packet does not fit at offset %d' % offset)
+    if not isinstance(buf, memoryview):
+      buf = memoryview(buf)
+    buf[offset:end] = RootLayerPacket._PREAMBLE
+    return _SerializeBlockInto(self._pdu_block, buf, end)
+
+
+class PDUView(object):
+  """One PDU of a block, parsed in place.
+
+  vector is a number, and header and data are memoryviews into the parsed
+  buffer. Where the PDU leaves out its vector, header or data, they are those
+  of the previous PDU in the block. offset and length locate the PDU itself.
+  """
+  __slots__ = ('vector', 'header', 'data', 'offset', 'length')
+
+  def __init__(self, vector, header, data, offset, length):
+    self.vector = vector
+    self.header = header
+    self.data = data
+    self.offset = offset
+    self.length = length
+
+
+def ParsePDUBlock(buf, vector_type='B', header_size=0, offset=0, end=None):
+  """Yields a PDUView for every PDU of the block in buf[offset:end].
+
+  buf is a str, bytearray or memoryview, and is not copied. The block's layer
+  defines the vector type and the header size, which is a number, or a dict
+  by vector for layers whose header depends on the vector. Parse a PDU's data
+  with another ParsePDUBlock call to get at the layer below.
+  Raises ParseError if a PDU does not fit the block or inherits its vector
+  or a header from a PDU that does not exist; data that is left out of the
+  first PDU is empty, as PDU.Serialize writes it.
+  """
+  view = buf if isinstance(buf, memoryview) else memoryview(buf)
+  if end is None:
+    end = len(view)
+  vector_field = _VECTOR_FIELDS[vector_type]
+  vector = header = data = None
+  while offset < end:
+    if offset + _FLAGS_AND_LENGTH.size > end:
+      raise ParseError('Truncated PDU at offset %d' % offset)
+    flags_and_length = _FLAGS_AND_LENGTH.unpack_from(view, offset)[0]
+    flags = flags_and_length >> 12
+    length = flags_and_length & 0xFFF
+    position = offset + _FLAGS_AND_LENGTH.size
+    if flags & _FLAG_LENGTH:
+      if position >= end:
+        raise ParseError('Truncated PDU at offset %d' % offset)
+      length = (length << 8) | ord(view[position])
+      position += 1
+    pdu_end = offset + length
+    if length < position - offset or pdu_end > end:
+      raise ParseError('PDU of %d bytes at offset %d does not fit a block '
+                       'ending at %d' % (length, offset, end))
+
+    if flags & PDU._FLAG_VECTOR:
+      if position + vector_field.size > pdu_end:
+        raise ParseError('PDU at offset %d too short for its vector' % offset)
+      vector = vector_field.unpack_from(view, position)[0]
+      position += vector_field.size
+    elif vector is None:
+      raise ParseError('First PDU of a block inherits its vector')
+    if isinstance(header_size, dict):
+      if vector not in header_size:
+        raise ParseError('Unknown vector 0x%x at offset %d' % (vector, offset))
+      size = header_size[vector]
+    else:
+      size = header_size
+    if flags & PDU._FLAG_HEADER:
+      if position + size > pdu_end:
+        raise ParseError('PDU at offset %d too short for its header' % offset)
+      header = view[position:position + size]
+      position += size
+    elif header is None:
+      if size:
+        raise ParseError('First PDU of a block inherits its header')
+      header = view[position:position]
+    if flags & PDU._FLAG_DATA:
+      data = view[position:pdu_end]
+    elif position != pdu_end:
+      raise ParseError('PDU at offset %d has %d bytes past its fields' %
+                       (offset, pdu_end - position))
+    elif data is None:
+      # PDU.Serialize leaves out empty data
+      data = view[position:position]
+    yield PDUView(vector, header, data, offset, length)
+    offset = pdu_end
+
+
+def ParseRootLayer(buf, end=None):
+  """Checks a root layer packet's preamble and yields its root PDUs.
+
+  The header of a root PDU is its sender's 16-byte CID.
+  """
+  view = buf if isinstance(buf, memoryview) else memoryview(buf)
+  preamble_size = len(RootLayerPacket._PREAMBLE)
+  if len(view) < preamble_size:
+    raise ParseError('Packet too short: %d bytes' % len(view))
+  if view[:preamble_size].tobytes() != RootLayerPacket._PREAMBLE:
+    raise ParseError('Not an ACN root layer packet')
+  return ParsePDUBlock(view, 'I', 16, offset=preamble_size, end=end)
+
 
 class UDPSender(object):
-  def __init__(self, addr='239.192.1.100', port=5569):
-    self._addr = addr
-    self._port = port
-    self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
+  """Sends datagrams to one or more destinations.
+
+  All destinations, (host, port) tuples, share one socket, and each is
+  resolved once, on first use, rather than on every send. Send errors are
+  counted per destination instead of raised, since one unreachable node
+  should not hold up the others.
+  """
+
+  def __init__(self, addr='239.192.1.100', port=5569, ttl=20, intf=None,
+               multicast_loop=True):
+    self._dest = (addr, port)
+    self._ttl = ttl
+    self._intf = intf
+    self._multicast_loop = multicast_loop
+    self._sock = None
+    # resolved addresses by destination, as tuples and as sockaddr_in for
+    # sendmmsg
+    self._addrs = {}
+    self._sockaddrs = {}
+    self._messages = None
+    self._errors = {}
+
+  def Close(self):
+    if self._sock:
+      self._sock.close()
+      self._sock = None
+    self._messages = None
+
+  def Send(self, data, dest=None):
+    """Sends data to dest, or to the address given to the constructor."""
+    self.SendBurst([(dest or self._dest, data)])
+
+  def SendBurst(self, packets):
+    """Sends [(dest, data)] in order.
+
+    Where the C library has sendmmsg, the whole burst goes out in a single
+    system call, whatever its destinations. data is a str, bytearray or
+    memoryview; see _Messages for how bytearrays are held.
+    """
+    if self._sock is None:
+      try:
+        self._sock = self._Open()
+      except socket.error, e:
+        for dest, data in packets:
+          self._CountErrors(dest, 1, e)
+        return
+    burst = []
+    for packet in packets:
+      dest = packet[0]
+      if dest not in self._addrs:
+        try:
+          self._Resolve(dest)
+        except socket.error, e:
+          self._CountErrors(dest, 1, e)
+          continue
+      burst.append(packet)
+    if _sendmmsg and len(burst) > 1:
+      self._SendMany(burst)
+      return
+    sendto = self._sock.sendto
+    addrs = self._addrs
+    for dest, data in burst:
+      try:
+        sendto(data, addrs[dest])
+      except socket.error, e:
+        self._CountErrors(dest, 1, e)
+
+  def Errors(self, reset=False):
+    """Returns the number of failed sends so far, keyed by destination."""
+    errors = dict(self._errors)
+    if reset:
+      self._errors = {}
+    return errors
 
-  def Send(self, data):
-    self._socket.sendto(data, (self._addr, self._port))
+  def _Open(self):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self._ttl)
+      sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP,
+                      int(self._multicast_loop))
+      if self._intf:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                        socket.inet_aton(self._intf))
+    except socket.error:
+      sock.close()
+      raise
+    return sock
+
+  def _Resolve(self, dest):
+    host, port = dest
+    ip = socket.gethostbyname(host)
+    self._addrs[dest] = (ip, port)
+    # struct sockaddr_in: family in host order, then port and address in
+    # network order
+    self._sockaddrs[dest] = ctypes.create_string_buffer(
+        struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) +
+        socket.inet_aton(ip) + '\0' * 8, _SOCKADDR_IN_SIZE)
+
+  def _SendMany(self, burst):
+    count = len(burst)
+    messages = self._messages
+    if messages is None or len(messages.iovs) < count:
+      messages = self._messages = _Messages(count)
+    messages.Point(burst, self._sockaddrs)
+    fd = self._sock.fileno()
+    sent = 0
+    while sent < count:
+      result = _sendmmsg(fd, ctypes.byref(messages.headers, sent *
+                                          ctypes.sizeof(_MMsgHdr)),
+                         count - sent, 0)
+      if result <= 0:
+        error = ctypes.get_errno()
+        if error == errno.EINTR:
+          continue
+        # skip the packet that failed and carry on with the rest
+        self._CountErrors(burst[sent][0], 1, os.strerror(error))
+        result = 1
+      sent += result
+
+  def _CountErrors(self, dest, count, error):
+    self._errors[dest] = self._errors.get(dest, 0) + count
+    logging.debug('UDP send to %s:%d failed: %s', dest[0], dest[1], error)
+
+
+_SOCKADDR_IN_SIZE = 16
+
+
+class _IoVec(ctypes.Structure):
+  _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+  _fields_ = [('msg_name', ctypes.c_void_p),
+              ('msg_namelen', ctypes.c_uint32),
+              ('msg_iov', ctypes.POINTER(_IoVec)),
+              ('msg_iovlen', ctypes.c_size_t),
+              ('msg_control', ctypes.c_void_p),
+              ('msg_controllen', ctypes.c_size_t),
+              ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+  _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _SendMMsg():
+  """Returns the C library's sendmmsg, or None where there is none."""
+  if platform.system() != 'Linux':
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    sendmmsg = libc.sendmmsg
+  except (OSError, AttributeError):
+    return None
+  sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                       ctypes.c_int]
+  sendmmsg.restype = ctypes.c_int
+  return sendmmsg
+
+_sendmmsg = _SendMMsg()
+
+
+class _Messages(object):
+  """sendmmsg headers, one packet each.
+
+  A sender that patches the same buffers every tick sends the same objects
+  to the same destinations in every burst, so the header of a bytearray or
+  str is only rebuilt when the object in its place changes, and its address
+  when the destination does. The ctypes view of a bytearray keeps it from
+  being resized while it is referenced here.
+  """
+
+  def __init__(self, count):
+    self.iovs = (_IoVec * count)()
+    self.headers = (_MMsgHdr * count)()
+    for i in xrange(count):
+      self.headers[i].msg_hdr.msg_iov = ctypes.pointer(self.iovs[i])
+      self.headers[i].msg_hdr.msg_iovlen = 1
+    self._dests = [None] * count
+    self._packets = [None] * count
+    # keeps the memory that the headers point at alive
+    self._buffers = [None] * count
+
+  def Point(self, burst, sockaddrs):
+    """Points the headers at the packets of burst, [(dest, data)].
+
+    sockaddrs holds the sockaddr_in of every dest, and must stay alive while
+    the headers are in use.
+    """
+    dests = self._dests
+    packets = self._packets
+    for i, (dest, data) in enumerate(burst):
+      if dests[i] != dest:
+        sockaddr = sockaddrs[dest]
+        header = self.headers[i].msg_hdr
+        header.msg_name = ctypes.addressof(sockaddr)
+        header.msg_namelen = len(sockaddr)
+        dests[i] = dest
+      if packets[i] is data and not isinstance(data, memoryview):
+        continue
+      if isinstance(data, bytearray):
+        buf = (ctypes.c_char * len(data)).from_buffer(data)
+      elif isinstance(data, memoryview):
+        # a memoryview can change under its object, so it is copied each time
+        buf = ctypes.c_char_p(data.tobytes())
+      else:
+        buf = ctypes.c_char_p(data)
+      packets[i] = data
+      self._buffers[i] = buf
+      iov = self.iovs[i]
+      iov.iov_base = ctypes.cast(buf, ctypes.c_void_p)
+      iov.iov_len = len(data)
 
 
 if __name__ == '__main__':
@@ -113,4 +584,10 @@ if __name__ == '__main__':
 
   root_layer_packet = RootLayerPacket()
   root_layer_packet.AddPDU(pdu)
-  print root_layer_packet.Serialize()
+  root_layer_packet.AddPDU(pdu2)
+  serialized = root_layer_packet.Serialize()
+  print serialized
+
+  for view in ParsePDUBlock(serialized.tostring(), 'I', 2,
+                            offset=len(RootLayerPacket._PREAMBLE)):
+    print view.vector, view.header.tobytes(), view.data.tobytes()
@@ -0,0 +1,187 @@
+# asyncio front end for the sACN receiver. Like the rest of the driver this is
+# Python 2 code, so it runs on trollius, the asyncio backport for Python 2.
+
+import errno
+import logging
+import sacn
+import scheduler
+import socket
+import trollius as asyncio
+
+class SACNProtocol(sacn.SACNReceiver, asyncio.DatagramProtocol):
+  """Receives sACN universes on an asyncio event loop.
+
+  Updates are delivered on the loop itself, either to a callback, which may
+  return a coroutine to be scheduled, or through Receive():
+
+    @asyncio.coroutine
+    def Consume(protocol):
+      while True:
+        update = yield asyncio.From(protocol.Receive())
+        if update is None:
+          break
+        universe, channels, dirty_ranges = update
+        ...
+
+  Universes that are updated several times before they are delivered are
+  coalesced, so only their newest frame is seen. The channels are a view of
+  the universe's slot in the store, which the next packet of the same
+  universe overwrites; copy it or use Snapshot() to keep it.
+  """
+
+  def __init__(self, universes=[1], callback=None, protocol=None,
+               console_universe_offset=0, loop=None):
+    super(SACNProtocol, self).__init__(
+        universes=universes, protocol=protocol,
+        console_universe_offset=console_universe_offset)
+    self._callback = callback
+    self._loop = loop or asyncio.get_event_loop()
+    self._transport = None
+    self._pending = []
+    self._waiters = []
+    self._flush_scheduled = False
+    self._closed = False
+
+  def connection_made(self, transport):
+    self._transport = transport
+
+  def connection_lost(self, exc):
+    self._closed = True
+    for waiter in self._waiters:
+      if not waiter.done():
+        waiter.set_result(None)
+    del self._waiters[:]
+
+  def error_received(self, exc):
+    logging.error("sACN receive failed: %s", exc)
+
+  def datagram_received(self, data, addr):
+    received = scheduler.monotonic()
+    try:
+      universe = self._ParsePacket(data, len(data))
+    except sacn.PacketParseError, e:
+      logging.error("Packet parse failed: %s", e)
+      return
+    if universe == -1:
+      return
+    self._NoteReceived(universe, received)
+    if universe not in self._pending:
+      self._pending.append(universe)
+    if not self._flush_scheduled:
+      self._flush_scheduled = True
+      self._loop.call_soon(self._Flush)
+
+  def Close(self):
+    if self._transport:
+      self._transport.close()
+
+  def Receive(self):
+    """Returns a future for the next (universe, channels, dirty_ranges).
+
+    Once the protocol is closed and every update was delivered, the future
+    resolves to None instead.
+    """
+    future = asyncio.Future(loop=self._loop)
+    if self._closed and not self._pending:
+      future.set_result(None)
+    elif self._pending and not self._flush_scheduled:
+      future.set_result(self._Deliver(self._pending.pop(0)))
+    else:
+      self._waiters.append(future)
+    return future
+
+  def _Flush(self):
+    self._flush_scheduled = False
+    pending = self._pending
+    while pending and self._waiters:
+      waiter = self._waiters.pop(0)
+      if waiter.done():
+        continue
+      waiter.set_result(self._Deliver(pending.pop(0)))
+    if self._callback:
+      for universe in pending:
+        result = self._callback(universe, self._store.Get(universe))
+        self._store.ClearDirty(universe)
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+          asyncio.ensure_future(result, loop=self._loop)
+      del pending[:]
+
+  def _Deliver(self, universe):
+    """Returns a Receive() result and starts the universe's next dirty set.
+
+    Receive() consumers resume later than the delivery, so the changes are
+    passed along with the levels: (universe, channels, dirty_ranges).
+    """
+    dirty_ranges = self._store.DirtyRanges(universe)
+    self._store.ClearDirty(universe)
+    return universe, self._store.Get(universe), dirty_ranges
+
+class _SocketTransport(asyncio.DatagramTransport):
+  """Read-only datagram transport around an already bound socket.
+
+  Datagrams are read into one preallocated buffer and handed to the protocol
+  as memoryviews, instead of as a new string per datagram.
+  """
+  _PACKET_SIZE = 1024
+  _MAX_DRAIN = 64
+
+  def __init__(self, loop, sock, protocol):
+    super(_SocketTransport, self).__init__({"socket": sock})
+    self._loop = loop
+    self._sock = sock
+    self._protocol = protocol
+    self._packet = bytearray(self._PACKET_SIZE)
+    self._view = memoryview(self._packet)
+    self._closing = False
+    self._loop.add_reader(self._sock.fileno(), self._OnReadable)
+    self._protocol.connection_made(self)
+
+  def _OnReadable(self):
+    for i in xrange(self._MAX_DRAIN):
+      try:
+        bytes_received, addr = self._sock.recvfrom_into(self._packet,
+                                                        self._PACKET_SIZE)
+      except socket.error, e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          self._protocol.error_received(e)
+        return
+      self._protocol.datagram_received(self._view[:bytes_received], addr)
+
+  def is_closing(self):
+    return self._closing
+
+  def close(self):
+    if self._closing:
+      return
+    self._closing = True
+    self._loop.remove_reader(self._sock.fileno())
+    self._sock.close()
+    self._loop.call_soon(self._protocol.connection_lost, None)
+
+  def abort(self):
+    self.close()
+
+def CreateSACNEndpoint(universes=[1], callback=None, protocol=None,
+                       console_universe_offset=0, intf=None, loop=None):
+  """Starts receiving universes on loop and returns the SACNProtocol."""
+  loop = loop or asyncio.get_event_loop()
+  sacn_protocol = SACNProtocol(
+      universes=universes, callback=callback, protocol=protocol,
+      console_universe_offset=console_universe_offset, loop=loop)
+  _SocketTransport(loop, sacn.OpenSocket(universes, intf=intf), sacn_protocol)
+  return sacn_protocol
+
+if __name__ == "__main__":
+  import sys
+  logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+  def Callback(universe, channels):
+    logging.debug("U%d: %s", universe,
+                  channels[0:8].tobytes().encode("string-escape"))
+  loop = asyncio.get_event_loop()
+  sacn_protocol = CreateSACNEndpoint(universes=[1,2,3,4], callback=Callback,
+                                     loop=loop)
+  try:
+    loop.run_forever()
+  finally:
+    sacn_protocol.Close()
+    loop.close()
@@ -1,12 +1,16 @@
-import array
 import logging
 import math
 import midi
+import dmxrouter
+import eventloop
+import latency
 import platform
 import sacn
+import sacncapture
+import sacnrelay
+import scheduler
 import serialdmx
 import sys
-import threading
 import time
 
 if __name__ == '__main__':
@@ -14,20 +18,74 @@ if __name__ == '__main__':
   logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
   # uncomment this to enable sending of test data
-  # test_data = [array.array('B', [5] * 512).tostring(),
-  #              array.array('B', [10] * 512).tostring(),
-  #              array.array('B', [15] * 512).tostring(),
-  #              array.array('B', [20] * 512).tostring()]
+  # test_data = [memoryview('\x05' * 512),
+  #              memoryview('\x0a' * 512),
+  #              memoryview('\x0f' * 512),
+  #              memoryview('\x14' * 512)]
   test_data = None
 
+  # set these to record received universes to a capture file, or to replay a
+  # capture instead of listening to the network
+  record_path = None
+  replay_path = None
+
   universes = [1,2,3,4]
   send_frame_rate = 33
+  # only send universes that changed, plus a full refresh once a second
+  delta_output = True
+  # drop frames while more than this many are still queued for the board
+  max_backlog = 1
+  # send all universes as one pre-interleaved frame, if the firmware takes it;
+  # firmware without bulk frames briefly shows filler on universe 3 when asked
+  bulk_frames = False
+  # send only the changed levels of each universe, with runs collapsed, if the
+  # firmware takes it
+  span_records = False
+  # set this to drive several boards, mapping each universe to a serial port
+  # and an output 1-4 on that board; the universes list above must include
+  # every routed universe
+  # routes = {1: ('/dev/ttyACM0', 1), 2: ('/dev/ttyACM0', 2),
+  #           3: ('/dev/ttyACM0', 3), 4: ('/dev/ttyACM0', 4),
+  #           5: ('/dev/ttyACM1', 1), 6: ('/dev/ttyACM1', 2)}
+  routes = None
+  # set this to also re-send the received universes to other hosts, e.g. to
+  # bridge VLANs; None stands for the universe's multicast group, sent on the
+  # interface with the relay_intf address. relay_renumber maps received
+  # universes to the numbers they are relayed as.
+  # relay_destinations = ['10.0.2.15', None]
+  # relay_renumber = {1: 101, 2: 102}
+  relay_destinations = None
+  relay_renumber = None
+  relay_intf = None
+  # turn this off to only relay, without a board
+  serial_output = True
+
+  # one thread serves the sACN socket and, where supported, the serial ports
+  event_loop = eventloop.EventLoop('avrdmx')
 
   system = platform.system()
-  if system == 'Windows':
-    serial_dmx = serialdmx.SerialDmx(port='COM3', set_dtr=True)
+  if not serial_output:
+    serial_dmx = None
+  elif routes:
+    serial_dmx = dmxrouter.DmxRouter(routes, set_dtr=True, delta=delta_output,
+                                     max_backlog=max_backlog,
+                                     event_loop=event_loop,
+                                     bulk=bulk_frames,
+                                     spans=span_records)
+  elif system == 'Windows':
+    serial_dmx = serialdmx.SerialDmx(port='COM3', set_dtr=True,
+                                     delta=delta_output,
+                                     max_backlog=max_backlog,
+                                     event_loop=event_loop,
+                                     bulk=bulk_frames,
+                                     spans=span_records)
   elif system == 'Linux':
-    serial_dmx = serialdmx.SerialDmx(port='/dev/ttyACM0', set_dtr=True)
+    serial_dmx = serialdmx.SerialDmx(port='/dev/ttyACM0', set_dtr=True,
+                                     delta=delta_output,
+                                     max_backlog=max_backlog,
+                                     event_loop=event_loop,
+                                     bulk=bulk_frames,
+                                     spans=span_records)
     master_fd = serial_dmx._port.fileno()
     libc = CDLL("libc.so.6")
     libc.unlockpt(master_fd)
@@ -44,12 +102,31 @@ if __name__ == '__main__':
   universe_data = {}
   receive_fps = {}
   send_fps = {}
+  # time from receiving a universe to writing it, see latency.py
+  latency_tracker = latency.LatencyTracker()
+  sacn_listener = None
+  recorder = None
+  if record_path:
+    recorder = sacncapture.SACNRecorder(record_path, universes=universes)
+  relay = None
+  if relay_destinations:
+    relay = sacnrelay.SACNRelay(universes, destinations=relay_destinations,
+                                renumber=relay_renumber, intf=relay_intf)
 
   def ReceiveChannels(universe, channels):
     global midi_cue
+    if recorder is not None:
+      recorder.Record(universe, channels)
+    if relay is not None:
+      relay.Relay(universe, channels)
     receive_fps[universe] = receive_fps.get(universe, 0) + 1
     universe_data[universe] = channels
-    if midi_sender is not None and universe == midi_universe:
+    # packets arriving before the listener is stored count as changes
+    changed = sacn_listener is None or sacn_listener.Changed(universe)
+    if changed and sacn_listener is not None:
+      # unchanged frames may not be written until the next refresh
+      latency_tracker.Handoff(universe, sacn_listener.ReceiveTimes(universe))
+    if midi_sender is not None and universe == midi_universe and changed:
       input_cue_float = 100.0 * ord(channels[midi_channel - 1]) / 255.0
       if input_cue_float - int(input_cue_float) > 0.5:
         input_cue_float += 1
@@ -61,28 +138,37 @@ if __name__ == '__main__':
         else:
           midi_sender.SendMSCGo(str(midi_cue))
 
-  sacn_listener = sacn.SACNListener(universes=universes,
-                                    callback=ReceiveChannels)
+  if replay_path:
+    sacn_listener = sacncapture.SACNReplayer(replay_path,
+                                             callback=ReceiveChannels,
+                                             universes=universes,
+                                             repeat=True)
+  else:
+    sacn_listener = sacn.SACNListener(universes=universes,
+                                      callback=ReceiveChannels,
+                                      coalesce=True,
+                                      event_loop=event_loop)
 
   def SendChannels():
-    start = time.clock()
-
     # TODO: better performance from sending universes one at a time, or sending
     # them all at once? use only one of SendUniverses or SendChannels
-    serial_dmx.SendUniverses(universe_data)
+    # The callback was given live views of the listener's store, which it
+    # updates from its own thread, so send from one consistent copy of it.
+    snapshot = sacn_listener.Snapshot()
+    frame = dict([(universe, snapshot.Get(universe)
+                   if isinstance(channels, memoryview) else channels)
+                  for universe, channels in universe_data.items()])
+    written = serial_dmx.SendUniverses(frame)
+    latency_tracker.Written(written)
 
-    for universe, channels in universe_data.iteritems():
-      # serial_dmx.SendChannels(channels, universe=universe)
+    for universe in written:
+      # serial_dmx.SendChannels(universe_data[universe], universe=universe)
       send_fps[universe] = send_fps.get(universe, 0) + 1
 
-    end = time.clock()
-
-    t = threading.Timer((1.0 / send_frame_rate) - (end - start),
-                        SendChannels)
-    t.daemon = True
-    t.start()
-
-  SendChannels()
+  output_scheduler = None
+  if serial_dmx is not None:
+    output_scheduler = scheduler.FrameScheduler(SendChannels, send_frame_rate,
+                                                name='DMXOutput')
 
   try:
     while True:
@@ -95,8 +181,24 @@ if __name__ == '__main__':
         time.sleep(1)
       logging.info('recv FPS: %s', str(receive_fps))
       logging.info('send FPS: %s', str(send_fps))
+      logging.info('latency: %s', latency_tracker.Report(reset=True))
+      if output_scheduler is not None:
+        logging.info('send timing: %s',
+                     str(output_scheduler.Stats(reset=True)))
+        logging.info('send dropped: %d', serial_dmx.DroppedFrames(reset=True))
+      if relay is not None:
+        logging.info('relay send errors: %d', relay.SendErrors(reset=True))
+      logging.info('sACN rejects: %s', str(sacn_listener.RejectCounts()))
       receive_fps.clear()
       send_fps.clear()
   finally:
+    if output_scheduler is not None:
+      output_scheduler.Close()
     sacn_listener.Close()
-    serial_dmx.Close()
+    if recorder is not None:
+      recorder.Close()
+    if relay is not None:
+      relay.Close()
+    if serial_dmx is not None:
+      serial_dmx.Close()
+    event_loop.Close()
@@ -0,0 +1,299 @@
+# Emulates an avrdmx board on a pseudo terminal, so that the host output path
+# can be benchmarked and checked without a board. Point SerialDmx at
+# PortName() and the emulator decodes what is written the way
+# leonardo_firmware/avrdmx.c does: a universe byte 0-3, then 512 levels that
+# are stored interleaved in the 2048-byte _chandata.
+#
+# It also answers PROTOCOL_QUERY and takes PROTOCOL_BULK_FRAME and
+# PROTOCOL_SPANS, unless it is told to emulate older firmware without those.
+#
+# The DMX line is modeled as in dmxout.S: all four universes are sent
+# together FRAME_RATE times a second, from whatever _chandata holds at the
+# start of the frame.
+#
+#   python avrdmxemulator.py [--seconds 10]
+
+import errno
+import logging
+import os
+import scheduler
+import select
+import serialdmx
+import struct
+import threading
+import time
+import tty
+
+# from dmxout.S
+FRAME_RATE = 33
+
+_SPAN = struct.Struct("!HH")
+
+class AvrDmxEmulator(object):
+  UNIVERSES = 4
+  CHANNELS = 512
+
+  def __init__(self, frame_rate=FRAME_RATE,
+               features=(serialdmx.PROTOCOL_FEATURE_BULK |
+                         serialdmx.PROTOCOL_FEATURE_SPANS),
+               query=True):
+    self._master, self._slave = os.openpty()
+    tty.setraw(self._master)
+    tty.setraw(self._slave)
+    self._port_name = os.ttyname(self._slave)
+
+    self._features = features
+    self._query = query
+    self._lock = threading.Lock()
+    self._chandata = bytearray(self.UNIVERSES * self.CHANNELS)
+    self._line = bytearray(self._chandata)
+    # _chandata index of the next level, or None while expecting a universe
+    self._position = None
+    # 0-3, a wrong universe byte, or None for a bulk frame
+    self._universe = None
+    self._stride = self.UNIVERSES
+    # query filler still to be skipped
+    self._skip = 0
+    # the PROTOCOL_SPANS record received so far
+    self._record = None
+    self.ResetStats()
+
+    self._active = True
+    self._thread = threading.Thread(target=self._Run, name="AvrDmxEmulator")
+    self._thread.start()
+    self._line_scheduler = scheduler.FrameScheduler(
+        self._SendLineFrame, frame_rate, name="AvrDmxEmulator line")
+    logging.info("Emulating an avrdmx board on %s", self._port_name)
+
+  def Close(self):
+    self._line_scheduler.Close()
+    self._active = False
+    self._thread.join()
+    os.close(self._master)
+    os.close(self._slave)
+
+  def PortName(self):
+    return self._port_name
+
+  def Levels(self, universe=1):
+    """Returns the levels of a universe as last sent on the DMX line."""
+    with self._lock:
+      return bytes(self._line[universe - 1::self.UNIVERSES])
+
+  def Stats(self, reset=False):
+    """Returns what was received and sent since the last reset.
+
+    received counts the complete universes decoded from the host, delivered
+    the line frames that carried new levels for a universe, and torn the line
+    frames that went out while that universe was only partly received. A bulk
+    frame counts as received for every universe. resync_errors counts spans
+    outside their universe, which the firmware receives but does not store,
+    and universe bytes outside 0-3, which the firmware takes
+    as an offset into _chandata and so scrambles the universes.
+    """
+    with self._lock:
+      stats = {
+        "seconds": time.time() - self._stats_start,
+        "bytes": self._bytes,
+        "line_frames": self._line_frames,
+        "received": dict(self._received),
+        "delivered": dict(self._delivered),
+        "torn": dict(self._torn),
+        "resync_errors": self._resync_errors,
+        "bulk_frames": self._bulk_frames,
+        "span_records": self._span_records,
+      }
+      if reset:
+        self._ResetStats()
+    return stats
+
+  def ResetStats(self):
+    with self._lock:
+      self._ResetStats()
+
+  def Report(self, reset=False):
+    """Returns the stats formatted as rates for logging."""
+    stats = self.Stats(reset=reset)
+    seconds = stats["seconds"] or 1.0
+    def Rates(counts):
+      return " ".join(["U%d=%.1f" % (u, counts.get(u, 0) / seconds)
+                       for u in xrange(1, self.UNIVERSES + 1)])
+    return ("recv fps %s | line fps %.1f delivered fps %s | torn %s | "
+            "resync errors %d | bulk frames %d | span records %d | "
+            "%.1f kB/s" %
+            (Rates(stats["received"]), stats["line_frames"] / seconds,
+             Rates(stats["delivered"]), Rates(stats["torn"]),
+             stats["resync_errors"], stats["bulk_frames"],
+             stats["span_records"], stats["bytes"] / seconds / 1000))
+
+  def _ResetStats(self):
+    self._stats_start = time.time()
+    self._bytes = 0
+    self._line_frames = 0
+    self._received = {}
+    self._delivered = {}
+    self._torn = {}
+    self._resync_errors = 0
+    self._bulk_frames = 0
+    self._span_records = 0
+
+  def _Run(self):
+    while self._active:
+      if not select.select([self._master], [], [], 0.1)[0]:
+        continue
+      try:
+        data = os.read(self._master, 4096)
+      except OSError, e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      with self._lock:
+        self._bytes += len(data)
+        self._Decode(data)
+
+  def _Decode(self, data):
+    """Feeds host bytes through the firmware's receive loop."""
+    chandata = self._chandata
+    end = len(chandata)
+    i = 0
+    while i < len(data):
+      if self._skip:
+        count = min(self._skip, len(data) - i)
+        self._skip -= count
+        i += count
+        continue
+      if self._record is not None:
+        received = len(self._record)
+        self._record += data[i:]
+        size = _SpansRecordSize(self._record)
+        if size is None:
+          return
+        i += size - received
+        self._ApplySpans(self._record[:size])
+        self._record = None
+        continue
+      if self._position is None:
+        self._StartRecord(ord(data[i]))
+        i += 1
+        continue
+      position = self._position
+      stride = self._stride
+      count = min((end - position + stride - 1) // stride, len(data) - i)
+      chandata[position:position + count * stride:stride] = data[i:i + count]
+      i += count
+      position += count * stride
+      if position < end:
+        self._position = position
+        continue
+      self._position = None
+      if self._universe is None:
+        self._bulk_frames += 1
+        universes = xrange(1, self.UNIVERSES + 1)
+      else:
+        universes = [self._universe + 1]
+      for universe in universes:
+        self._received[universe] = self._received.get(universe, 0) + 1
+
+  def _StartRecord(self, byte):
+    if self._query and byte == serialdmx.PROTOCOL_QUERY:
+      os.write(self._master, chr(serialdmx.PROTOCOL_REPLY | self._features))
+      self._skip = serialdmx.PROTOCOL_QUERY_FILLER
+      return
+    if (self._features & serialdmx.PROTOCOL_FEATURE_SPANS and
+        byte == serialdmx.PROTOCOL_SPANS):
+      self._record = bytearray([byte])
+      return
+    if (self._features & serialdmx.PROTOCOL_FEATURE_BULK and
+        byte == serialdmx.PROTOCOL_BULK_FRAME):
+      self._position = 0
+      self._universe = None
+      self._stride = 1
+      return
+    if byte >= self.UNIVERSES:
+      self._resync_errors += 1
+    self._position = byte
+    self._universe = byte
+    self._stride = self.UNIVERSES
+
+  def _ApplySpans(self, record):
+    """Stores the levels of a complete PROTOCOL_SPANS record."""
+    universe = record[1]
+    position = 3
+    for i in xrange(record[2]):
+      start, length = _SPAN.unpack_from(record, position)
+      position += _SPAN.size
+      run = length & serialdmx.PROTOCOL_SPAN_RUN
+      length &= ~serialdmx.PROTOCOL_SPAN_RUN
+      if run:
+        levels = record[position:position + 1] * length
+        position += 1
+      else:
+        levels = record[position:position + length]
+        position += length
+      if universe >= self.UNIVERSES or start + length > self.CHANNELS:
+        self._resync_errors += 1
+        continue
+      first = start * self.UNIVERSES + universe
+      self._chandata[first:first + length * self.UNIVERSES:
+                     self.UNIVERSES] = levels
+    self._span_records += 1
+    if universe < self.UNIVERSES:
+      self._received[universe + 1] = self._received.get(universe + 1, 0) + 1
+
+  def _SendLineFrame(self):
+    with self._lock:
+      self._line_frames += 1
+      receiving = ()
+      if self._record is not None and len(self._record) > 1:
+        receiving = (self._record[1] + 1,)
+      elif self._position is not None:
+        if self._universe is None:
+          receiving = xrange(1, self.UNIVERSES + 1)
+        else:
+          receiving = (self._universe + 1,)
+      for universe in xrange(1, self.UNIVERSES + 1):
+        levels = self._chandata[universe - 1::self.UNIVERSES]
+        if levels != self._line[universe - 1::self.UNIVERSES]:
+          self._delivered[universe] = self._delivered.get(universe, 0) + 1
+        if universe in receiving:
+          self._torn[universe] = self._torn.get(universe, 0) + 1
+      self._line[:] = self._chandata
+
+def _SpansRecordSize(record):
+  """Returns the size of the PROTOCOL_SPANS record that record starts with.
+
+  Returns None while the record is incomplete.
+  """
+  if len(record) < 3:
+    return None
+  position = 3
+  for i in xrange(record[2]):
+    if position + _SPAN.size > len(record):
+      return None
+    length = _SPAN.unpack_from(record, position)[1]
+    position += _SPAN.size
+    if length & serialdmx.PROTOCOL_SPAN_RUN:
+      position += 1
+    else:
+      position += length
+  if position > len(record):
+    return None
+  return position
+
+if __name__ == "__main__":
+  import argparse
+  import sys
+  logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--seconds", type=float, default=None,
+                      help="stop after this long instead of running until ^C")
+  args = parser.parse_args()
+
+  emulator = AvrDmxEmulator()
+  start = time.time()
+  try:
+    while args.seconds is None or time.time() - start < args.seconds:
+      time.sleep(1)
+      logging.info(emulator.Report(reset=True))
+  finally:
+    emulator.Close()
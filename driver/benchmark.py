@@ -0,0 +1,326 @@
+# Throughput benchmarks for the sACN receive, ACN serialize and serial output
+# hot paths. Run this with the same interpreter as the driver and compare the
+# numbers between releases:
+#
+#   python benchmark.py [--seconds 2] [--universes 4] [--pty]
+
+import acn
+import argparse
+import logging
+import sacn
+import sacnsender
+import serialdmx
+import struct
+import sys
+import timeit
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+_CID = "avrdmx-benchmark"
+_SOURCE_NAME = "avrdmx benchmark"
+# E1.31 framing layer header sizes by vector: data and synchronization
+_FRAMING_HEADER_SIZES = {0x02: 71, 0x01: 5}
+
+
+def BuildDataPacket(protocol, universe, levels, sequence=0, priority=100,
+                    start_code=0, cid=_CID):
+  """Builds an E1.31 data packet with acn.PDU and acn.RootLayerPacket."""
+  levels = bytearray(levels)
+  if protocol == sacn.SACNReceiver.PROTOCOL_V2:
+    root_vector = 0x03
+    framing_header = struct.pack("!32sBBH", _SOURCE_NAME, priority, sequence,
+                                 universe)
+    dmp_header = struct.pack("!BHHH", 0xA1, start_code, 1, len(levels))
+    dmp_data = bytes(levels)
+  else:
+    root_vector = 0x04
+    framing_header = struct.pack("!64sBHBBH", _SOURCE_NAME, priority, 0,
+                                 sequence, 0, universe)
+    dmp_header = struct.pack("!BHHH", 0xA1, 0, 1, len(levels) + 1)
+    dmp_data = chr(start_code) + bytes(levels)
+
+  dmp = acn.PDU()
+  dmp.SetVector(0x02, 'B')
+  dmp.SetHeader(dmp_header)
+  dmp.SetData(dmp_data)
+
+  framing = acn.PDU()
+  framing.SetVector(0x02, 'I')
+  framing.SetHeader(framing_header)
+  framing.SetData(dmp)
+
+  root = acn.PDU()
+  root.SetVector(root_vector, 'I')
+  root.SetHeader(cid)
+  root.SetData(framing)
+
+  root_layer_packet = acn.RootLayerPacket()
+  root_layer_packet.AddPDU(root)
+  return root_layer_packet
+
+
+def BuildCorpus(universes, sources=1):
+  """Returns a list of (name, [packet bytearray]) for both protocols.
+
+  With several sources, each one sends every universe at the same priority,
+  so that the receiver has to merge them.
+  """
+  corpus = []
+  for protocol, name in ((sacn.SACNReceiver.PROTOCOL_V2, "V2"),
+                         (sacn.SACNReceiver.PROTOCOL_V3, "V3")):
+    packets = []
+    # a full cycle of sequence numbers, so that replaying the corpus in a loop
+    # is never rejected as out of order
+    for sequence in xrange(256):
+      for universe in universes:
+        for source in xrange(sources):
+          levels = [(universe * 7 + source * 3 + sequence + i) & 0xFF
+                    for i in xrange(512)]
+          packet = BuildDataPacket(protocol, universe, levels,
+                                   sequence=sequence,
+                                   cid="%-16d" % source)
+          packets.append(bytearray(packet.Serialize().tostring()))
+    if sources > 1:
+      name += " %d sources" % sources
+    corpus.append((name, packets))
+  return corpus
+
+
+class _MemoryPort(object):
+  """In-memory stand-in for serial.Serial that discards what is written.
+
+  It answers the protocol query with the given PROTOCOL_FEATURE_* flags.
+  """
+
+  def __init__(self, features=0):
+    self.bytes_written = 0
+    self.timeout = None
+    self._features = features
+    self._reply = ""
+
+  def write(self, data):
+    if len(data) and bytearray(data[:1])[0] == serialdmx.PROTOCOL_QUERY:
+      self._reply = chr(serialdmx.PROTOCOL_REPLY | self._features)
+    self.bytes_written += len(data)
+    return len(data)
+
+  def read(self, size=1):
+    reply, self._reply = self._reply[:size], self._reply[size:]
+    return reply
+
+  def setDTR(self, value):
+    pass
+
+  def close(self):
+    pass
+
+
+def _MemorySerialDmx(bulk=False, spans=False):
+  port = _MemoryPort(features=serialdmx.PROTOCOL_FEATURE_BULK |
+                     serialdmx.PROTOCOL_FEATURE_SPANS)
+  return serialdmx.SerialDmx(set_dtr=False, bulk=bulk, spans=spans,
+                             serial_port=port)
+
+
+def _PtySerialDmx():
+  import os
+  import threading
+  import tty
+  from ctypes import CDLL, c_char_p
+
+  serial_dmx = serialdmx.SerialDmx(port="/dev/ptmx", set_dtr=False)
+  master_fd = serial_dmx._port.fileno()
+  libc = CDLL("libc.so.6")
+  libc.unlockpt(master_fd)
+  libc.ptsname.restype = c_char_p
+  slave = os.open(libc.ptsname(master_fd), os.O_RDONLY)
+  # canonical mode would block the writer once a line's worth is buffered
+  tty.setraw(slave)
+
+  def Drain():
+    try:
+      while os.read(slave, 4096):
+        pass
+    except OSError:
+      pass
+  drain_thread = threading.Thread(target=Drain)
+  drain_thread.daemon = True
+  drain_thread.start()
+  return serial_dmx
+
+
+def _AllocatedBytes(fn):
+  """Returns the peak number of bytes allocated by one call of fn.
+
+  Returns None without tracemalloc. Python 2 only has it with the
+  pytracemalloc backport, which needs a patched interpreter.
+  """
+  if not tracemalloc:
+    return None
+  fn()
+  tracemalloc.start()
+  try:
+    fn()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def Measure(name, fn, items_per_call, bytes_per_call, seconds):
+  """Calls fn repeatedly for about the given time and reports its rate."""
+  calls = 0
+  batch = 1
+  timer = timeit.default_timer
+  start = timer()
+  elapsed = 0.0
+  while elapsed < seconds:
+    for i in xrange(batch):
+      fn()
+    calls += batch
+    batch *= 2
+    elapsed = timer() - start
+  items_per_second = calls * items_per_call / elapsed
+  bytes_per_second = calls * bytes_per_call / elapsed
+  allocated = _AllocatedBytes(fn)
+  result = {
+    "name": name,
+    "items_per_second": items_per_second,
+    "bytes_per_second": bytes_per_second,
+    "allocated_bytes_per_call": allocated,
+  }
+  if allocated is None:
+    logging.info("%-40s %12.0f pkt/s %10.2f MB/s",
+                 name, items_per_second, bytes_per_second / 1e6)
+  else:
+    logging.info("%-40s %12.0f pkt/s %10.2f MB/s %10d alloc B/call",
+                 name, items_per_second, bytes_per_second / 1e6, allocated)
+  return result
+
+
+def RunBenchmarks(seconds=2.0, universes=(1, 2, 3, 4), pty=False):
+  universes = list(universes)
+  results = []
+  if not tracemalloc:
+    logging.warning("tracemalloc is not available, so allocations are not "
+                    "measured; on Python 2 it needs the pytracemalloc "
+                    "backport")
+
+  receiver = sacn.SACNReceiver(universes=universes)
+  for protocol_name, packets in (BuildCorpus(universes) +
+                                 BuildCorpus(universes, sources=2)):
+    size = sum(len(p) for p in packets)
+    def Parse(packets=packets):
+      for packet in packets:
+        receiver._ParsePacket(packet, len(packet))
+    results.append(Measure("SACNReceiver._ParsePacket %s" % protocol_name,
+                           Parse, len(packets), size, seconds))
+  # the same packets walked layer by layer with the generic PDU parser
+  v3_packets = dict(BuildCorpus(universes))["V3"]
+  def ParseNested(packets=v3_packets):
+    for packet in packets:
+      for root in acn.ParseRootLayer(packet):
+        for framing in acn.ParsePDUBlock(root.data, 'I',
+                                         _FRAMING_HEADER_SIZES):
+          for dmp in acn.ParsePDUBlock(framing.data, 'B', 1):
+            pass
+  results.append(Measure("acn.ParsePDUBlock V3 nested", ParseNested,
+                         len(v3_packets), sum(len(p) for p in v3_packets),
+                         seconds))
+
+  rejects = dict([(reason, count)
+                  for reason, count in receiver.RejectCounts().iteritems()
+                  if count])
+  if rejects:
+    logging.warning("Corpus packets were rejected: %s", rejects)
+
+  root_layer_packet = BuildDataPacket(sacn.SACNReceiver.PROTOCOL_V3,
+                                      universes[0], [0x55] * 512)
+  root_pdu = root_layer_packet._pdu_block[0]
+  pdu_size = len(root_pdu.Serialize())
+  results.append(Measure("acn.PDU.Serialize", root_pdu.Serialize, 1,
+                         pdu_size, seconds))
+  results.append(Measure("RootLayerPacket.Serialize",
+                         root_layer_packet.Serialize, 1,
+                         pdu_size + len(acn.RootLayerPacket._PREAMBLE),
+                         seconds))
+  packet_buffer = bytearray(root_layer_packet.Size())
+  results.append(Measure("RootLayerPacket.SerializeInto",
+                         lambda: root_layer_packet.SerializeInto(packet_buffer),
+                         1, len(packet_buffer), seconds))
+
+  # to the discard port, so that the packets go nowhere after the syscall
+  sender = sacnsender.SACNSender(universes=universes, dest="127.0.0.1",
+                                 port=9)
+  try:
+    sender_data = dict([(universe, bytes(bytearray([universe] * 512)))
+                        for universe in universes])
+    results.append(Measure("SACNSender.SendUniverses",
+                           lambda: sender.SendUniverses(sender_data),
+                           len(universes),
+                           len(sender.Packet(universes[0])) * len(universes),
+                           seconds))
+  finally:
+    sender.Close()
+
+  if pty:
+    serial_dmx = _PtySerialDmx()
+  else:
+    serial_dmx = _MemorySerialDmx()
+  try:
+    universe_data = dict([(universe, bytes(bytearray([universe] * 512)))
+                          for universe in universes])
+    def SendChannels():
+      for universe, channels in universe_data.iteritems():
+        serial_dmx.SendChannels(channels, universe=universe)
+    results.append(Measure("SerialDmx.SendChannels", SendChannels,
+                           len(universes), 513 * len(universes), seconds))
+    results.append(Measure("SerialDmx.SendUniverses",
+                           lambda: serial_dmx.SendUniverses(universe_data),
+                           len(universes), 513 * len(universes), seconds))
+  finally:
+    serial_dmx.Close()
+
+  if len(universes) <= 4:
+    bulk_serial_dmx = _MemorySerialDmx(bulk=True)
+    results.append(Measure("SerialDmx.SendUniverses bulk",
+                           lambda: bulk_serial_dmx.SendUniverses(universe_data),
+                           len(universes), serialdmx.SerialDmx._BULK_SIZE,
+                           seconds))
+
+  # a few channels changing over mostly dark universes
+  spans_serial_dmx = _MemorySerialDmx(spans=True)
+  sparse_frames = []
+  for level in (0x20, 0xC0):
+    sparse_frames.append(dict([(universe,
+                                bytes(bytearray([level] * 8 + [0] * 504)))
+                               for universe in universes]))
+  def SendSparse(frames=sparse_frames):
+    for frame in frames:
+      spans_serial_dmx.SendUniverses(frame)
+  results.append(Measure("SerialDmx.SendUniverses spans", SendSparse,
+                         2 * len(universes), 2 * 513 * len(universes),
+                         seconds))
+  port = spans_serial_dmx._port
+  port.bytes_written = 0
+  SendSparse()
+  logging.info("%-40s %12.1f link B/universe", "",
+               port.bytes_written / (2.0 * len(universes)))
+  return results
+
+
+if __name__ == "__main__":
+  logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                      format="%(message)s")
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--seconds", type=float, default=2.0,
+                      help="time spent on each benchmark")
+  parser.add_argument("--universes", type=int, default=4,
+                      help="number of universes in the corpus")
+  parser.add_argument("--pty", action="store_true",
+                      help="write serial output to a pty instead of memory")
+  args = parser.parse_args()
+  RunBenchmarks(seconds=args.seconds,
+                universes=range(1, args.universes + 1),
+                pty=args.pty)
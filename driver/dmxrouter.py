@@ -0,0 +1,193 @@
+# Sends universes to several avrdmx boards from one process. A routing table
+# maps each logical universe to a serial port and one of the board's outputs:
+#
+#   routes = {1: ('/dev/ttyACM0', 1), 2: ('/dev/ttyACM0', 2),
+#             5: ('/dev/ttyACM1', 1)}
+#
+# Every board is written from its own thread, so a slow or disconnected board
+# only drops its own frames. With an event loop, the ports are also written
+# without blocking, see SerialDmx.
+
+import logging
+import serial
+import serialdmx
+import threading
+import time
+
+# outputs on one board, addressed by the universe byte 0-3
+BOARD_UNIVERSES = 4
+
+class DmxRouter(object):
+  """Offers the SerialDmx output interface over several boards."""
+
+  def __init__(self, routes, set_dtr=True, delta=False, max_backlog=None,
+               event_loop=None, bulk=False, spans=False):
+    self._routes = dict(routes)
+    self._universes = {}
+    for universe, (port, slot) in self._routes.iteritems():
+      if not 1 <= slot <= BOARD_UNIVERSES:
+        raise ValueError("Universe %d routed to output %d of %s, boards have "
+                         "outputs 1-%d" % (universe, slot, port,
+                                           BOARD_UNIVERSES))
+      if (port, slot) in self._universes:
+        raise ValueError("Universes %d and %d both routed to output %d of %s" %
+                         (self._universes[(port, slot)], universe, slot, port))
+      self._universes[(port, slot)] = universe
+
+    self._writers = {}
+    for port in sorted(set([port for port, slot in self._routes.values()])):
+      self._writers[port] = _DeviceWriter(port, set_dtr=set_dtr, delta=delta,
+                                          max_backlog=max_backlog,
+                                          event_loop=event_loop, bulk=bulk,
+                                          spans=spans)
+
+  def Close(self):
+    for writer in self._writers.itervalues():
+      writer.Close()
+
+  def Ports(self):
+    return sorted(self._writers.keys())
+
+  def SendUniverses(self, universes):
+    """Hands the universes to their boards' writers and returns immediately.
+
+    Returns the universes whose writes completed since the previous call. A
+    writer that is still busy with an earlier frame skips to this one.
+    """
+    frames = dict([(port, {}) for port in self._writers])
+    for universe, channels in universes.iteritems():
+      route = self._routes.get(universe)
+      if route is not None:
+        port, slot = route
+        frames[port][slot] = channels
+    for port, frame in frames.iteritems():
+      if frame:
+        self._writers[port].Submit(frame)
+
+    written = []
+    for port, writer in self._writers.iteritems():
+      for slot in writer.TakeWritten():
+        written.append(self._universes[(port, slot)])
+    return written
+
+  def OutWaiting(self):
+    return sum([writer.OutWaiting() for writer in self._writers.itervalues()])
+
+  def DroppedFrames(self, reset=False):
+    return sum([writer.DroppedFrames(reset=reset)
+                for writer in self._writers.itervalues()])
+
+class _DeviceWriter(object):
+  """Writes the newest frame for one board from a thread of its own.
+
+  If the port cannot be opened or a write fails, frames for this board are
+  discarded until it is opened again, which is retried every RETRY_INTERVAL
+  seconds.
+  """
+  RETRY_INTERVAL = 1.0
+
+  def __init__(self, port, set_dtr=True, delta=False, max_backlog=None,
+               event_loop=None, bulk=False, spans=False):
+    self._port = port
+    self._set_dtr = set_dtr
+    self._delta = delta
+    self._max_backlog = max_backlog
+    self._event_loop = event_loop
+    self._bulk = bulk
+    self._spans = spans
+    self._serial_dmx = None
+    self._next_open = 0
+
+    self._cond = threading.Condition()
+    self._pending = None
+    self._written = set()
+    self._dropped_frames = 0
+
+    self._active = True
+    self._thread = threading.Thread(target=self._Run,
+                                    name="DmxWriter %s" % port)
+    self._thread.start()
+
+  def Close(self):
+    with self._cond:
+      self._active = False
+      self._cond.notify()
+    self._thread.join()
+    if self._serial_dmx:
+      self._serial_dmx.Close()
+      self._serial_dmx = None
+
+  def Submit(self, universes):
+    with self._cond:
+      if self._pending is not None:
+        self._dropped_frames += 1
+      self._pending = universes
+      self._cond.notify()
+
+  def TakeWritten(self):
+    with self._cond:
+      written = self._written
+      self._written = set()
+    return written
+
+  def OutWaiting(self):
+    serial_dmx = self._serial_dmx
+    return serial_dmx.OutWaiting() if serial_dmx else 0
+
+  def DroppedFrames(self, reset=False):
+    with self._cond:
+      dropped = self._dropped_frames
+      if reset:
+        self._dropped_frames = 0
+    serial_dmx = self._serial_dmx
+    if serial_dmx:
+      dropped += serial_dmx.DroppedFrames(reset=reset)
+    return dropped
+
+  def _Open(self):
+    now = time.time()
+    if now < self._next_open:
+      return None
+    try:
+      self._serial_dmx = serialdmx.SerialDmx(port=self._port,
+                                             set_dtr=self._set_dtr,
+                                             delta=self._delta,
+                                             max_backlog=self._max_backlog,
+                                             event_loop=self._event_loop,
+                                             bulk=self._bulk,
+                                             spans=self._spans)
+    except (serial.SerialException, OSError), e:
+      logging.error("Cannot open DMX board %s: %s", self._port, e)
+      self._next_open = now + self.RETRY_INTERVAL
+    return self._serial_dmx
+
+  def _Disconnect(self):
+    serial_dmx = self._serial_dmx
+    self._serial_dmx = None
+    self._next_open = time.time() + self.RETRY_INTERVAL
+    try:
+      serial_dmx.Close()
+    except (serial.SerialException, OSError), e:
+      logging.debug("Closing DMX board %s failed: %s", self._port, e)
+
+  def _Run(self):
+    while True:
+      with self._cond:
+        while self._active and self._pending is None:
+          self._cond.wait()
+        if not self._active:
+          return
+        universes = self._pending
+        self._pending = None
+
+      serial_dmx = self._serial_dmx or self._Open()
+      if serial_dmx is None:
+        continue
+      try:
+        written = serial_dmx.SendUniverses(universes)
+      except (serial.SerialException, OSError), e:
+        logging.error("DMX board %s disconnected: %s", self._port, e)
+        self._Disconnect()
+        continue
+      with self._cond:
+        self._written.update(written)
@@ -0,0 +1,145 @@
+import errno
+import logging
+import select
+import socket
+import threading
+
+class EventLoop(object):
+  """Waits on several sockets from one thread and dispatches the ready ones.
+
+  Readers and writers can be sockets or anything else with a fileno() that
+  select() accepts, such as a non-blocking serial port on POSIX systems.
+
+  An exception from a callback is logged, and the loop carries on.
+
+  The thread blocks in select() without a timeout. Adding or removing a reader
+  or writer and closing the loop wake it through a loopback socket, so they
+  take effect at once instead of on the next poll.
+  """
+
+  def __init__(self, name="EventLoop"):
+    self._readers = {}
+    self._writers = {}
+    self._cond = threading.Condition()
+    self._generation = 0
+
+    self._wakeup_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._wakeup_sock.bind(("127.0.0.1", 0))
+    self._wakeup_sock.setblocking(False)
+    self._wakeup_addr = self._wakeup_sock.getsockname()
+    self._wakeup_sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    self._active = True
+    self._thread = threading.Thread(target=self._Run, name=name)
+    self._thread.start()
+
+  def Close(self):
+    with self._cond:
+      self._active = False
+    self._Wakeup()
+    if threading.current_thread() is not self._thread:
+      self._thread.join()
+    self._wakeup_sock.close()
+    self._wakeup_sender.close()
+
+  def AddReader(self, sock, callback):
+    """Calls callback() on the loop thread whenever sock is readable."""
+    with self._cond:
+      self._readers[sock] = callback
+    self._Wakeup()
+
+  def RemoveReader(self, sock):
+    """Stops watching sock.
+
+    When called from another thread, this waits until the loop has gone back
+    to select(), so the callback is not running and will not run again once
+    this returns, and the caller may close sock.
+    """
+    self._Remove(self._readers, sock)
+
+  def AddWriter(self, sock, callback):
+    """Calls callback() on the loop thread whenever sock is writable."""
+    with self._cond:
+      self._writers[sock] = callback
+    self._Wakeup()
+
+  def RemoveWriter(self, sock):
+    """Stops waiting for sock to be writable, like RemoveReader."""
+    self._Remove(self._writers, sock)
+
+  def _Remove(self, callbacks, sock):
+    with self._cond:
+      if callbacks.pop(sock, None) is None:
+        return
+      if (threading.current_thread() is self._thread or
+          not self._thread.is_alive()):
+        return
+      generation = self._generation
+      self._Wakeup()
+      while self._generation == generation and self._thread.is_alive():
+        self._cond.wait(0.1)
+
+  def _Wakeup(self):
+    try:
+      self._wakeup_sender.sendto("\0", self._wakeup_addr)
+    except socket.error, e:
+      logging.error("Failed to wake up event loop: %s", e)
+
+  def _DrainWakeup(self):
+    while True:
+      try:
+        self._wakeup_sock.recv(64)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+
+  def _Run(self):
+    while True:
+      with self._cond:
+        self._generation += 1
+        self._cond.notify_all()
+        if not self._active:
+          break
+        readers = self._readers.keys()
+        writers = self._writers.keys()
+      try:
+        readable, writable = select.select(readers + [self._wakeup_sock],
+                                           writers, [])[:2]
+      except (select.error, IOError, ValueError), e:
+        # a reader or writer was closed without being removed first
+        logging.error("Event loop select failed: %s", e)
+        with self._cond:
+          for callbacks, socks in ((self._readers, readers),
+                                   (self._writers, writers)):
+            for sock in socks:
+              if sock in callbacks and _IsClosed(sock):
+                del callbacks[sock]
+        continue
+      for sock in readable:
+        if sock is self._wakeup_sock:
+          self._DrainWakeup()
+          continue
+        with self._cond:
+          callback = self._readers.get(sock)
+        if callback:
+          _Dispatch(callback)
+      for sock in writable:
+        with self._cond:
+          callback = self._writers.get(sock)
+        if callback:
+          _Dispatch(callback)
+
+def _Dispatch(callback):
+  # the loop thread is shared, so one failing reader or writer must not stop
+  # the others
+  try:
+    callback()
+  except Exception:
+    logging.exception("Event loop callback failed")
+
+def _IsClosed(sock):
+  try:
+    return sock.fileno() < 0
+  except (IOError, ValueError):
+    return True
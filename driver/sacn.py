@@ -1,167 +1,575 @@
 # sACN protocol definition based on http://sacnview.cvs.sourceforge.net
 #   /viewvc/sacnview/SACNView/src/StreamingACN.pas?view=markup
 
-import array
+import binascii
+import errno
+import eventloop
 import logging
+import scheduler
 import socket
 import struct
 import sys
 import threading
 import time
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 class PacketParseError(Exception):
   """Failed to parse a packet."""
 
-class ArraySliceIterator(object):
-  def __init__(self, arr):
-    self._arr = arr
-    self._i = 0
+PORT = 5568
+_ZERO_CHANNELS = memoryview("\0" * 512)
 
-  def next(self):
-    result = self._arr[self._i]
-    self._i += 1
-    return result
+def UniverseAddress(universe):
+  """Returns the multicast group that a universe is sent to."""
+  hi = (universe & 0xFF00) >> 8
+  lo = universe & 0xFF
+  return "239.255.%d.%d" % (hi, lo)
 
-  def take(self, n):
-    result = self._arr[self._i:self._i + n]
-    self._i += n
-    return result
+def OpenSocket(universes, intf=None):
+  """Opens a non-blocking UDP socket joined to the universes' groups."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+  except AttributeError:
+    pass
+  sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 20)
+  sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
+  sock.bind(("", PORT))
+  if not intf:
+    intf = socket.gethostbyname(socket.gethostname())
+  sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF,
+                  socket.inet_aton(intf))
+  for universe in universes:
+    universe_ip = UniverseAddress(universe)
+    sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP,
+                    socket.inet_aton(universe_ip) + socket.inet_aton(intf))
+    logging.info("Listening to sACN universe %d on %s:%d",
+                 universe, universe_ip, PORT)
+  sock.setblocking(False)
+  return sock
+
+class UniverseStore(object):
+  """Channel levels of many universes in one contiguous buffer.
+
+  Every universe owns a fixed 512-byte slot of a preallocated bytearray, which
+  the parser updates in place, so the store does not allocate per packet no
+  matter how many universes it holds. Get returns a read-only view of a
+  universe's live slot, for the thread that updates the store. Other threads
+  should read from a Snapshot, which copies all slots at once into an
+  immutable buffer and never sees a slot halfway through an Update.
+
+  Update compares new levels with the slot in 32-channel blocks and copies
+  only the blocks that differ. Each universe has a version that counts its
+  changes, and a set of dirty blocks that accumulates until ClearDirty.
+  """
+  CHANNELS = 512
+  DIRTY_BLOCK = 32
+
+  def __init__(self, universes):
+    self._slots = {}
+    for universe in universes:
+      self._slots.setdefault(universe, len(self._slots))
+    self._slab = bytearray(len(self._slots) * self.CHANNELS)
+    slab = memoryview(self._slab)
+    self._views = dict(
+        [(universe, slab[slot * self.CHANNELS:(slot + 1) * self.CHANNELS])
+         for universe, slot in self._slots.iteritems()])
+    # buffer() makes the views that Get hands out read-only
+    read_only = memoryview(buffer(self._slab))
+    self._read_only_views = dict(
+        [(universe, read_only[slot * self.CHANNELS:(slot + 1) * self.CHANNELS])
+         for universe, slot in self._slots.iteritems()])
+    # held while a slot is written in blocks, so that Snapshot sees whole
+    # frames
+    self._lock = threading.Lock()
+    self._versions = dict.fromkeys(self._slots, 0)
+    self._dirty = dict.fromkeys(self._slots, 0)
+    self._padded = bytearray(self.CHANNELS)
+    self._padded_view = memoryview(self._padded)
+
+  def __contains__(self, universe):
+    return universe in self._slots
+
+  def __len__(self):
+    return len(self._slots)
+
+  def Universes(self):
+    return sorted(self._slots)
+
+  def Get(self, universe):
+    """Returns a read-only memoryview of the universe's levels.
+
+    The view is updated in place, so it may change between two reads unless
+    it is read on the thread that updates the store.
+    """
+    return self._read_only_views[universe]
+
+  def Update(self, universe, levels):
+    """Copies levels, zero-padded to 512, into the universe's slot.
+
+    Returns True if the slot changed.
+    """
+    slot = self._views[universe]
+    count = len(levels)
+    if count < self.CHANNELS:
+      self._padded[:count] = levels
+      self._padded[count:] = _ZERO_CHANNELS[count:]
+      levels = self._padded_view
+    if slot == levels:
+      return False
+    dirty = 0
+    block = self.DIRTY_BLOCK
+    with self._lock:
+      for i in xrange(self.CHANNELS // block):
+        start = i * block
+        end = start + block
+        if slot[start:end] != levels[start:end]:
+          slot[start:end] = levels[start:end]
+          dirty |= 1 << i
+    self._dirty[universe] |= dirty
+    self._versions[universe] += 1
+    return True
+
+  def Version(self, universe):
+    """Returns a number that increases whenever the universe changes."""
+    return self._versions[universe]
+
+  def IsDirty(self, universe):
+    return self._dirty[universe] != 0
+
+  def DirtyRanges(self, universe):
+    """Returns [(start, end)] channel index ranges changed since ClearDirty."""
+    ranges = []
+    dirty = self._dirty[universe]
+    block = self.DIRTY_BLOCK
+    for i in xrange(self.CHANNELS // block):
+      if dirty & (1 << i):
+        if ranges and ranges[-1][1] == i * block:
+          ranges[-1] = (ranges[-1][0], (i + 1) * block)
+        else:
+          ranges.append((i * block, (i + 1) * block))
+    return ranges
+
+  def ClearDirty(self, universe):
+    self._dirty[universe] = 0
+
+  def Snapshot(self):
+    with self._lock:
+      data = str(self._slab)
+    return UniverseSnapshot(self._slots, data)
+
+class UniverseSnapshot(object):
+  """Read-only copy of a UniverseStore taken at one point in time."""
+
+  def __init__(self, slots, data):
+    self._slots = slots
+    self._data = memoryview(data)
+
+  def __contains__(self, universe):
+    return universe in self._slots
 
-class SACNListener(object):
+  def Get(self, universe):
+    slot = self._slots[universe]
+    return self._data[slot * UniverseStore.CHANNELS:
+                      (slot + 1) * UniverseStore.CHANNELS]
+
+class _Source(object):
+  __slots__ = ("priority", "last_seen", "levels", "array")
+
+  def __init__(self):
+    self.priority = 0
+    self.last_seen = 0
+    self.levels = None
+    self.array = None
+
+class UniverseMerger(object):
+  """Merges the sources that send the same universe into its store slot.
+
+  Only the sources with the highest priority count, and their levels are
+  merged highest-takes-precedence. With numpy the merge is numpy.maximum over
+  arrays that wrap the sources' buffers; without it, _MaxLevels compares all
+  levels at once as one long integer, which is several times slower than
+  numpy but still avoids a Python step per channel.
+  While a single source is sending, its levels go straight to the slot and no
+  per-source copy is kept.
+  """
+  # E1.31 6.7.1: a source that has not sent for this long is gone
+  SOURCE_TIMEOUT = 2.5
+
+  def __init__(self, store, universe):
+    self._store = store
+    self._universe = universe
+    self._sources = {}
+    self._merged = bytearray(store.CHANNELS)
+    if numpy:
+      self._merged_array = numpy.frombuffer(self._merged, dtype=numpy.uint8)
+
+  def SourceCount(self):
+    return len(self._sources)
+
+  def Update(self, cid, priority, levels, now):
+    """Records a source's levels and rewrites the merged slot."""
+    source = self._sources.get(cid)
+    if source is None:
+      source = _Source()
+      self._sources[cid] = source
+      if len(self._sources) == 2:
+        # the first source's levels are only in the slot so far
+        for other in self._sources.itervalues():
+          if other is not source:
+            self._Track(other)[:] = self._store.Get(self._universe)
+    source.priority = priority
+    source.last_seen = now
+    self._Expire(now)
+
+    if len(self._sources) == 1:
+      self._store.Update(self._universe, levels)
+      return
+    _CopyLevels(self._Track(source), levels)
+    self._Merge()
+
+  def Remove(self, cid, now):
+    """Drops a source that terminated its stream."""
+    if self._sources.pop(cid, None) is not None:
+      self._Expire(now)
+      if self._sources:
+        self._Merge()
+
+  def _Track(self, source):
+    if source.levels is None:
+      source.levels = bytearray(self._store.CHANNELS)
+      if numpy:
+        source.array = numpy.frombuffer(source.levels, dtype=numpy.uint8)
+    return source.levels
+
+  def _Expire(self, now):
+    if len(self._sources) < 2:
+      return
+    for cid, source in self._sources.items():
+      if now - source.last_seen > self.SOURCE_TIMEOUT:
+        del self._sources[cid]
+
+  def _Merge(self):
+    sources = self._sources.values()
+    priority = max([source.priority for source in sources])
+    winners = [source for source in sources if source.priority == priority]
+    if len(winners) == 1:
+      self._store.Update(self._universe, winners[0].levels)
+      return
+    if numpy:
+      merged = self._merged_array
+      numpy.maximum(winners[0].array, winners[1].array, out=merged)
+      for source in winners[2:]:
+        numpy.maximum(merged, source.array, out=merged)
+    else:
+      _MaxLevels(self._merged, [source.levels for source in winners])
+    self._store.Update(self._universe, self._merged)
+
+# bit masks over the levels of a universe read as one big-endian integer
+_LEVEL_BITS = 8 * UniverseStore.CHANNELS
+_ALL_LEVELS = (1 << _LEVEL_BITS) - 1
+_LEVEL_HIGH_BITS = int("80" * UniverseStore.CHANNELS, 16)
+_LEVEL_LOW_BITS = _ALL_LEVELS ^ _LEVEL_HIGH_BITS
+
+def _MaxLevels(dest, sources):
+  """Writes the highest of each level of the sources' buffers into dest.
+
+  Each buffer is read as one integer, so that the comparisons of all levels
+  are a handful of long integer operations. Setting the high bit of every
+  level of one side keeps the subtraction of the other side's low bits from
+  borrowing across levels, and leaves that bit set where the low bits are
+  greater or equal.
+  """
+  merged = int(binascii.hexlify(sources[0]), 16)
+  for levels in sources[1:]:
+    other = int(binascii.hexlify(levels), 16)
+    low_ge = (merged | _LEVEL_HIGH_BITS) - (other & _LEVEL_LOW_BITS)
+    ge = (((~(merged ^ other) & low_ge) | (merged & ~other)) &
+          _LEVEL_HIGH_BITS)
+    # 0xFF in each level where merged >= other
+    mask = (ge >> 7) * 0xFF
+    merged = (merged & mask) | (other & (_ALL_LEVELS ^ mask))
+  dest[:] = binascii.unhexlify("%0*x" % (_LEVEL_BITS // 4, merged))
+
+def _CopyLevels(dest, levels):
+  count = len(levels)
+  dest[:count] = levels
+  if count < len(dest):
+    dest[count:] = _ZERO_CHANNELS[count:len(dest)]
+
+class SACNReceiver(object):
+  """Parses sACN packets into per-universe channel buffers.
+
+  It holds no socket, so SACNListener and other transports can share it.
+  """
   PROTOCOL_V2, PROTOCOL_V3 = range(2)
-  _PORT = 5568
+  _CHANNELS = UniverseStore.CHANNELS
+  _IDENTIFIER = "ASC-E1.17\0\0\0"
 
-  def __init__(self, universes=[1], callback=None, protocol=None,
-               console_universe_offset=0):
+  # Root layer and the fixed part of the framing layer, which are shared by
+  # both protocol versions: PreambleSize, PostambleSize, Identifier, RLPFlags,
+  # RLPVector, CID, FLFlags, FLVector.
+  _ROOT_LAYER = struct.Struct("!HH12sHI16sHI")
+
+  # Remainder of the framing layer plus the DMP layer header, keyed by protocol
+  # version. Each entry is (layout, offset of the first DMX level).
+  #   V2: SourceName (skipped), Priority, SequenceNumber, Universe, DMPFlags,
+  #       DMPVector, DMPAddrType, StartCode, AddressIncrement, PropertyCount
+  #   V3: SourceName (skipped), Priority, Reserved, SequenceNumber, Options,
+  #       Universe, DMPFlags, DMPVector, DMPAddrType, DMPFirstPropAddr,
+  #       AddressIncrement, PropertyCount, StartCode
+  _FRAMING_LAYER = {
+    PROTOCOL_V2: (struct.Struct("!32xBBHHBBHHH"), 90),
+    PROTOCOL_V3: (struct.Struct("!64xBHBBHHBBHHHB"), 126),
+  }
+
+  # Reasons for dropping a well-formed packet before its levels are copied.
+  REJECT_UNIVERSE = "universe"
+  REJECT_SEQUENCE = "sequence"
+  REJECT_PREVIEW = "preview"
+  REJECT_START_CODE = "start_code"
+  _REJECT_REASONS = (REJECT_UNIVERSE, REJECT_SEQUENCE, REJECT_PREVIEW,
+                     REJECT_START_CODE)
+
+  # E1.31 6.7.2: a packet whose sequence number is less than 20 behind the
+  # last one from the same source and universe is stale or out of order.
+  _SEQUENCE_WINDOW = 20
+  _OPTION_PREVIEW = 0x80
+  _OPTION_STREAM_TERMINATED = 0x40
+
+  def __init__(self, universes=[1], protocol=None, console_universe_offset=0):
     self._universes = universes
-    self._callback = callback
     self._protocol = protocol
     self._console_universe_offset = console_universe_offset
-    self._channels = dict([(universe, array.array('B', [0] * 512).tostring())
-                           for universe in universes])
+    self._store = UniverseStore(universes)
+    self._mergers = {}
+    self._sequence_numbers = {}
+    self._rejects = dict.fromkeys(self._REJECT_REASONS, 0)
+    self._receive_times = {}
 
-    self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    try:
-      self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-    except AttributeError:
-      pass
-    self._sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 20)
-    self._sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
-    self._sock.bind(("", self._PORT))
-    intf = socket.gethostbyname(socket.gethostname())
-    self._sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF,
-                          socket.inet_aton(intf))
-    for universe in universes:
-      hi = (universe & 0xFF00) >> 8
-      lo = universe & 0xFF
-      universe_ip = "239.255.%d.%d" % (hi, lo)
-      self._sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP,
-                            socket.inet_aton(universe_ip) +
-                            socket.inet_aton(intf))
-      logging.info("Listening to sACN universe %d on %s:%d",
-                   universe, universe_ip, self._PORT)
-    self._sock.settimeout(1)
-
-    self._active = True
-    self._read_thread = threading.Thread(target=self._Read)
-    self._read_thread.start()
+  def GetChannels(self, universe=1):
+    return self._store.Get(universe)
 
-  def Close(self):
-    self._active = False
-    self._sock.close()
-    self._read_thread.join()
-    logging.info("Stopped listening to sACN universes %s", self._universes)
+  def Snapshot(self):
+    """Returns a consistent read-only copy of every universe's levels."""
+    return self._store.Snapshot()
 
-  def GetChannels(self, universe=1):
-    return self._channels[universe]
+  def Version(self, universe=1):
+    """Returns a number that increases whenever the universe's levels change.
+
+    Consumers that run on their own schedule can compare it with the version
+    they last handled to skip unchanged universes.
+    """
+    return self._store.Version(universe)
+
+  def Changed(self, universe=1):
+    """Returns whether the universe changed since its previous delivery.
+
+    This and DirtyRanges are meant to be called from the callback, and cover
+    every packet that was coalesced into the delivery.
+    """
+    return self._store.IsDirty(universe)
+
+  def DirtyRanges(self, universe=1):
+    """Returns [(start, end)] channel ranges changed since the last delivery."""
+    return self._store.DirtyRanges(universe)
+
+  def SourceCount(self, universe=1):
+    """Returns the number of sources currently merged into the universe."""
+    merger = self._mergers.get(universe)
+    return merger.SourceCount() if merger else 0
+
+  def RejectCounts(self):
+    """Returns the number of packets dropped so far, keyed by reason."""
+    return dict(self._rejects)
+
+  def ReceiveTimes(self, universe=1):
+    """Returns (received, parsed) for the universe's newest packet.
+
+    The times are scheduler.monotonic() readings taken when the datagram was
+    read and when its levels had been stored, for latency.LatencyTracker.
+    Returns None before the universe's first packet.
+    """
+    return self._receive_times.get(universe)
+
+  def _NoteReceived(self, universe, received):
+    self._receive_times[universe] = (received, scheduler.monotonic())
+
+  def _ParsePacket(self, packet, length=None):
+    """Parses an E1.31 data packet into its universe's channel buffer.
 
-  def _ParsePacket(self, packet):
+    The fields are decoded in place from a view of the receive buffer, and the
+    DMX levels are merged with the universe's other sources into its slot of
+    the store.
+    Returns the universe number, or -1 if the packet carries no levels for a
+    universe we listen to. Packets for other universes, stale or out of order
+    packets, preview data and alternate start codes are rejected from the
+    header alone and counted in RejectCounts.
+    """
     def ExpectEq(expected, actual, field=None):
       if expected != actual:
         raise PacketParseError("Expected %s but got %s for field %s" %
                                (str(expected), str(actual), field))
 
-    it = ArraySliceIterator(packet)
+    if length is None:
+      length = len(packet)
+    view = memoryview(packet)
 
-    ExpectEq(0x0010, struct.unpack("!H", it.take(2))[0], "PreambleSize")
-    ExpectEq(0x0000, struct.unpack("!H", it.take(2))[0], "PostambleSize")
-    ExpectEq("ASC-E1.17\0\0\0", struct.unpack("12s", it.take(12))[0],
-             "Identifier")
-    rlp_flags = struct.unpack("!H", it.take(2))[0]
-    pdu_length = rlp_flags & 0x0FFF
+    if length < self._ROOT_LAYER.size:
+      raise PacketParseError("Packet too short: %d bytes" % length)
+    (preamble_size, postamble_size, identifier, rlp_flags, vector, cid,
+     unused_fl_flags, fl_vector) = self._ROOT_LAYER.unpack_from(view)
+    ExpectEq(0x0010, preamble_size, "PreambleSize")
+    ExpectEq(0x0000, postamble_size, "PostambleSize")
+    ExpectEq(self._IDENTIFIER, identifier, "Identifier")
     ExpectEq(0x7, (rlp_flags & 0xF000) >> 12, "RLPFlags")
 
-    vector = struct.unpack("!I", it.take(4))[0]
-    if self._protocol:
+    if self._protocol is not None:
       protocol = self._protocol
     elif vector == 0x03:
       protocol = self.PROTOCOL_V2
     elif vector == 0x04:
       protocol = self.PROTOCOL_V3
     else:
-      raise PacketParseError("Unknown protocol vector %d", vector)
+      raise PacketParseError("Unknown protocol vector %d" % vector)
+    ExpectEq(0x00000002, fl_vector, "FLVector")
 
-    unused_cid = struct.unpack("!IHHH6s", it.take(16))[0]
-
-    unused_fl_flags = struct.unpack("!H", it.take(2))[0]
-    ExpectEq(0x00000002, struct.unpack("!I", it.take(4))[0], "FLVector")
+    layout, data_offset = self._FRAMING_LAYER[protocol]
+    if length < data_offset:
+      raise PacketParseError("Packet too short: %d bytes" % length)
     if protocol == self.PROTOCOL_V2:
-      unused_source_name = struct.unpack("32s", it.take(32))[0]
-      unused_priority = it.next()
-      unused_sequence_number = it.next()
-    elif protocol == self.PROTOCOL_V3:
-      unused_source_name = struct.unpack("64s", it.take(64))[0]
-      unused_priority = it.next()
-      unused_reserved = struct.unpack("!H", it.take(2))[0]
-      unused_sequence_number = it.next()
-      unuesd_options = it.next()
-    universe = struct.unpack("!H", it.take(2))[0]
+      (priority, sequence_number, universe,
+       unused_dmp_flags, dmp_vector, dmp_addr_type, start_code,
+       address_increment, dmx_length) = layout.unpack_from(
+           view, self._ROOT_LAYER.size)
+      options = 0
+    else:
+      (priority, unused_reserved, sequence_number,
+       options, universe, unused_dmp_flags, dmp_vector, dmp_addr_type,
+       first_prop_addr, address_increment, dmx_length,
+       start_code) = layout.unpack_from(view, self._ROOT_LAYER.size)
     universe += self._console_universe_offset
+    if universe not in self._store:
+      self._rejects[self.REJECT_UNIVERSE] += 1
+      return -1
 
-    unused_dmp_flags = struct.unpack("!H", it.take(2))[0]
-    ExpectEq(0x02, it.next(), "DMPVector")
-    ExpectEq(0xA1, it.next(), "DMPAddrType")
-    if protocol == self.PROTOCOL_V2:
-      start_code = struct.unpack("!H", it.take(2))[0]
-      ExpectEq(0x0001, struct.unpack("!H", it.take(2))[0], "AddressIncrement")
-      dmx_length = struct.unpack("!H", it.take(2))[0]
-    elif protocol == self.PROTOCOL_V3:
-      ExpectEq(0x0000, struct.unpack("!H", it.take(2))[0], "DMPFirstPropAddr")
-      ExpectEq(0x0001, struct.unpack("!H", it.take(2))[0], "AddressIncrement")
-      dmx_length = struct.unpack("!H", it.take(2))[0]
-      start_code = it.next()
+    if protocol == self.PROTOCOL_V3:
+      ExpectEq(0x0000, first_prop_addr, "DMPFirstPropAddr")
+      # the V3 property count includes the start code
+      dmx_length -= 1
+    ExpectEq(0x02, dmp_vector, "DMPVector")
+    ExpectEq(0xA1, dmp_addr_type, "DMPAddrType")
+    ExpectEq(0x0001, address_increment, "AddressIncrement")
+
+    # the sequence covers every start code, so check it before filtering them
+    stream = (cid, universe)
+    last_sequence_number = self._sequence_numbers.get(stream)
+    if last_sequence_number is not None:
+      delta = (sequence_number - last_sequence_number) & 0xFF
+      if delta == 0 or delta > 0x100 - self._SEQUENCE_WINDOW:
+        self._rejects[self.REJECT_SEQUENCE] += 1
+        return -1
+    self._sequence_numbers[stream] = sequence_number
+    if options & self._OPTION_PREVIEW:
+      self._rejects[self.REJECT_PREVIEW] += 1
+      return -1
     if start_code != 0:
+      self._rejects[self.REJECT_START_CODE] += 1
       return -1
-    self._channels[universe] = (
-      it.take(min(512, dmx_length)) +
-      array.array('B', [0] * max(512 - dmx_length, 0))).tostring()
+
+    merger = self._mergers.get(universe)
+    if merger is None:
+      merger = UniverseMerger(self._store, universe)
+      self._mergers[universe] = merger
+    if options & self._OPTION_STREAM_TERMINATED:
+      merger.Remove(cid, scheduler.monotonic())
+      return universe
+    count = max(0, min(self._CHANNELS, dmx_length, length - data_offset))
+    merger.Update(cid, priority, view[data_offset:data_offset + count],
+                  scheduler.monotonic())
     return universe
 
-  def _Read(self):
-    packet = array.array('B', [0] * 1024)
-    while self._active:
-      try:
-        bytes_received = self._sock.recv_into(packet, 1024)
-        universe = self._ParsePacket(packet)
-        logging.debug("sACN listener received %d bytes for universe %d",
-                      bytes_received, universe)
-        if universe != -1:
-          if self._callback:
-            self._callback(universe, self._channels[universe])
-      except PacketParseError, e:
-        logging.error("Packet parse failed: %s", e)
-        continue
-      except socket.timeout:
-        continue
-      except socket.error, e:
-        logging.error("sACN read aborting: %s", e)
-        break
+class SACNListener(SACNReceiver):
+  _PACKET_SIZE = 1024
+  _MAX_DRAIN = 64
+
+  def __init__(self, universes=[1], callback=None, protocol=None,
+               console_universe_offset=0, coalesce=False,
+               event_loop=None):
+    super(SACNListener, self).__init__(
+        universes=universes, protocol=protocol,
+        console_universe_offset=console_universe_offset)
+    self._callback = callback
+    self._coalesce = coalesce
+    self._packet = bytearray(self._PACKET_SIZE)
+    self._sock = OpenSocket(universes)
+
+    # several listeners may share one event loop thread
+    self._owns_event_loop = event_loop is None
+    if self._owns_event_loop:
+      event_loop = eventloop.EventLoop(name="SACNListener")
+    self._event_loop = event_loop
+    self._event_loop.AddReader(self._sock, self._OnReadable)
+
+  def Close(self):
+    self._event_loop.RemoveReader(self._sock)
+    self._sock.close()
+    if self._owns_event_loop:
+      self._event_loop.Close()
+    logging.info("Stopped listening to sACN universes %s", self._universes)
+
+  def _Receive(self, updated):
+    """Reads and parses one datagram, noting its universe in updated.
+
+    Returns False if no datagram was queued on the socket.
+    """
+    try:
+      bytes_received = self._sock.recv_into(self._packet, self._PACKET_SIZE)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return False
+      raise
+    received = scheduler.monotonic()
+    try:
+      universe = self._ParsePacket(self._packet, bytes_received)
+    except PacketParseError, e:
+      logging.error("Packet parse failed: %s", e)
+      return True
+    if universe != -1:
+      self._NoteReceived(universe, received)
+    logging.debug("sACN listener received %d bytes for universe %d",
+                  bytes_received, universe)
+    if universe != -1 and universe not in updated:
+      updated.append(universe)
+    return True
+
+  def _OnReadable(self):
+    updated = []
+    try:
+      if self._Receive(updated) and self._coalesce:
+        # Drain the datagrams that are already queued. Each one overwrites
+        # its universe's channel buffer, so only the newest frame of each
+        # universe reaches the callback.
+        drained = 0
+        while drained < self._MAX_DRAIN and self._Receive(updated):
+          drained += 1
+    except socket.error, e:
+      logging.error("sACN read aborting: %s", e)
+      self._event_loop.RemoveReader(self._sock)
+    for universe in updated:
+      if self._callback:
+        self._callback(universe, self._store.Get(universe))
+      self._store.ClearDirty(universe)
 
 if __name__ == "__main__":
   logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
   def Callback(universe, channels):
-    logging.debug("U%d: %s", universe, channels[0:8].encode("string-escape"))
+    logging.debug("U%d: %s", universe,
+                  channels[0:8].tobytes().encode("string-escape"))
   sacn_listener = SACNListener(universes=[1,2,3,4], callback=Callback)
   try:
     while True:
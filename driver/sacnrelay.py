@@ -0,0 +1,92 @@
+# Re-sends received sACN universes to other hosts or networks, e.g. to bridge
+# VLANs, from the same process that drives the boards, so the packets are
+# parsed only once:
+#
+#   relay = SACNRelay([1, 2], destinations=['10.0.2.15', None],
+#                     renumber={1: 101}, intf='10.0.2.1')
+#   listener = sacn.SACNListener(universes=[1, 2], callback=relay.Relay)
+#
+# A destination of None is the output universe's multicast group.
+#
+#   python sacnrelay.py --universes 1 2 --destinations 10.0.2.15 multicast
+#                       [--renumber 1:101 2:102] [--intf 10.0.2.1]
+
+import logging
+import sacnsender
+
+class SACNRelay(object):
+  """Re-sends the levels of received universes as a source of its own.
+
+  Relay takes the same arguments as the SACNListener callback, so it can be
+  called from the callback or be the callback itself. Every frame is copied
+  once into the packet of its output universe, which then goes to all
+  destinations from that one buffer.
+
+  The relay's multicast is not looped back to this host, so a listener here
+  does not receive and relay it again.
+  """
+
+  def __init__(self, universes, destinations=[None], renumber=None,
+               source_name="avrdmx relay", priority=100, intf=None):
+    self._renumber = dict(renumber or {})
+    self._outputs = {}
+    for universe in universes:
+      output = self._renumber.get(universe, universe)
+      for other, other_output in self._outputs.iteritems():
+        if other_output == output:
+          raise ValueError("Universes %d and %d both relayed as universe %d" %
+                           (other, universe, output))
+      self._outputs[universe] = output
+    self._sender = sacnsender.SACNSender(
+        universes=sorted(self._outputs.values()), source_name=source_name,
+        priority=priority, intf=intf, destinations=destinations,
+        multicast_loop=False)
+    logging.info("Relaying sACN universes %s to %s",
+                 ", ".join(["%d as %d" % (universe, output)
+                            for universe, output in
+                            sorted(self._outputs.iteritems())]),
+                 ", ".join([host or "multicast" for host in destinations]))
+
+  def Close(self):
+    self._sender.Close()
+
+  def Relay(self, universe, channels):
+    output = self._outputs.get(universe)
+    if output is None:
+      return
+    self._sender.SendUniverses({output: channels})
+
+  def SendErrors(self, reset=False):
+    return self._sender.SendErrors(reset=reset)
+
+if __name__ == "__main__":
+  import argparse
+  import sacn
+  import sys
+  import time
+  logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--universes", type=int, nargs="+", default=[1,2,3,4])
+  parser.add_argument("--destinations", nargs="+", default=["multicast"],
+                      help="hosts to relay to, or multicast for the output "
+                           "universe's group")
+  parser.add_argument("--renumber", nargs="*", default=[],
+                      help="input:output universe pairs")
+  parser.add_argument("--intf", default=None,
+                      help="address of the interface to relay multicast on")
+  args = parser.parse_args()
+
+  renumber = dict([map(int, pair.split(":")) for pair in args.renumber])
+  destinations = [None if host == "multicast" else host
+                  for host in args.destinations]
+  relay = SACNRelay(args.universes, destinations=destinations,
+                    renumber=renumber, intf=args.intf)
+  sacn_listener = sacn.SACNListener(universes=args.universes,
+                                    callback=relay.Relay, coalesce=True)
+  try:
+    while True:
+      time.sleep(1)
+      logging.info("relay send errors: %d", relay.SendErrors(reset=True))
+  finally:
+    sacn_listener.Close()
+    relay.Close()
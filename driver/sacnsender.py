@@ -0,0 +1,251 @@
+# Sends sACN (E1.31) universes, to feed other nodes or to drive a
+# SACNListener in tests.
+#
+# The data packet of every universe is assembled once with acn.PDU and
+# acn.RootLayerPacket, with all 512 levels. Afterwards only the sequence
+# number, priority, options and levels are patched into it in place, and the
+# packets of all universes go out as one acn.UDPSender burst, so one process
+# can keep hundreds of universes going at 44 Hz.
+#
+#   python sacnsender.py [--universes 1 2 3 4 | --count 200] [--rate 44]
+#                        [--dest 127.0.0.1] [--seconds 10]
+
+import acn
+import logging
+import sacn
+import scheduler
+import struct
+import threading
+import uuid
+
+# E1.31 6.2.6: a source that stops sends three packets with this option set
+_TERMINATE_PACKETS = 3
+_ZERO_LEVELS = "\0" * 512
+
+class SACNSender(object):
+  """Sends the levels of several universes through an acn.UDPSender.
+
+  Levels are sent when SendUniverses or Send is called and, with a
+  frame_rate, also refreshed that many times a second from a thread of its
+  own, as receivers time out universes that stop arriving.
+
+  Packets go to each universe's multicast group, or all to dest if it is
+  given, e.g. "127.0.0.1" to reach a SACNListener on this host. To send
+  every universe to several hosts, list them in destinations instead, with
+  None standing for the universe's multicast group; all copies of a packet
+  are sent from the same buffer. multicast_loop=False keeps this host's
+  listeners from receiving the multicast packets.
+  """
+  PROTOCOL_V2 = sacn.SACNReceiver.PROTOCOL_V2
+  PROTOCOL_V3 = sacn.SACNReceiver.PROTOCOL_V3
+  CHANNELS = sacn.UniverseStore.CHANNELS
+
+  _OPTION_STREAM_TERMINATED = sacn.SACNReceiver._OPTION_STREAM_TERMINATED
+
+  def __init__(self, universes=[1], source_name="avrdmx", priority=100,
+               protocol=PROTOCOL_V3, cid=None, dest=None, port=sacn.PORT,
+               intf=None, frame_rate=None, destinations=None,
+               multicast_loop=True):
+    self._protocol = protocol
+    self._cid = cid or uuid.uuid4().bytes
+    self._source_name = source_name
+    self._lock = threading.Lock()
+    if destinations is None:
+      destinations = [dest]
+    self._packets = {}
+    for universe in universes:
+      self._packets[universe] = _UniversePacket(
+          self._BuildPacket(universe, priority),
+          self._Layout(),
+          [(host or sacn.UniverseAddress(universe), port)
+           for host in destinations])
+
+    self._udp_sender = acn.UDPSender(intf=intf, multicast_loop=multicast_loop)
+
+    self._scheduler = None
+    if frame_rate:
+      self._scheduler = scheduler.FrameScheduler(self.Send, frame_rate,
+                                                 name="SACNSender")
+    logging.info("Sending sACN universes %s", sorted(self._packets))
+
+  def Close(self):
+    """Stops sending and tells receivers that the universes ended."""
+    if self._scheduler:
+      self._scheduler.Close()
+      self._scheduler = None
+    with self._lock:
+      for packet in self._packets.itervalues():
+        packet.SetOption(self._OPTION_STREAM_TERMINATED)
+    for i in xrange(_TERMINATE_PACKETS):
+      self.Send()
+    self._udp_sender.Close()
+    logging.info("Stopped sending sACN universes %s", sorted(self._packets))
+
+  def Universes(self):
+    return sorted(self._packets)
+
+  def SetLevels(self, universe, levels):
+    """Stores levels for the universe's next send; missing levels are 0."""
+    with self._lock:
+      self._packets[universe].SetLevels(levels)
+
+  def SetPriority(self, universe, priority):
+    with self._lock:
+      self._packets[universe].SetPriority(priority)
+
+  def SendUniverses(self, universes):
+    """Stores and sends {universe: levels} right away."""
+    with self._lock:
+      for universe, levels in universes.iteritems():
+        self._packets[universe].SetLevels(levels)
+    self.Send(universes.keys())
+
+  def Send(self, universes=None):
+    """Sends the stored levels of the universes, or of all of them."""
+    if universes is None:
+      universes = self._packets.keys()
+    with self._lock:
+      burst = []
+      for universe in universes:
+        packet = self._packets[universe]
+        data = packet.Next()
+        for addr in packet.addrs:
+          burst.append((addr, data))
+      self._udp_sender.SendBurst(burst)
+
+  def Packet(self, universe):
+    """Returns a copy of the universe's packet as it was last sent."""
+    with self._lock:
+      return bytes(self._packets[universe].data)
+
+  def SendErrors(self, reset=False):
+    """Returns the number of packets that failed to send."""
+    with self._lock:
+      return sum(self._udp_sender.Errors(reset=reset).values())
+
+  def Stats(self, reset=False):
+    """Returns the send timing, if sending at a frame_rate."""
+    if self._scheduler:
+      return self._scheduler.Stats(reset=reset)
+    return None
+
+  def _BuildPacket(self, universe, priority):
+    """Returns a data packet for the universe with every level at 0."""
+    # the source name is a NUL-terminated string
+    if self._protocol == self.PROTOCOL_V2:
+      root_vector = 0x03
+      framing_header = struct.pack("!32sBBH", self._source_name[:31],
+                                   priority, 0, universe)
+      dmp_header = struct.pack("!BHHH", 0xA1, 0, 1, self.CHANNELS)
+      dmp_data = "\0" * self.CHANNELS
+    else:
+      root_vector = 0x04
+      framing_header = struct.pack("!64sBHBBH", self._source_name[:63],
+                                   priority, 0, 0, 0, universe)
+      dmp_header = struct.pack("!BHHH", 0xA1, 0, 1, self.CHANNELS + 1)
+      # start code 0, then the levels
+      dmp_data = "\0" * (self.CHANNELS + 1)
+
+    dmp = acn.PDU()
+    dmp.SetVector(0x02, 'B')
+    dmp.SetHeader(dmp_header)
+    dmp.SetData(dmp_data)
+
+    framing = acn.PDU()
+    framing.SetVector(0x02, 'I')
+    framing.SetHeader(framing_header)
+    framing.SetData(dmp)
+
+    root = acn.PDU()
+    root.SetVector(root_vector, 'I')
+    root.SetHeader(self._cid)
+    root.SetData(framing)
+
+    root_layer_packet = acn.RootLayerPacket()
+    root_layer_packet.AddPDU(root)
+    packet = bytearray(root_layer_packet.Size())
+    root_layer_packet.SerializeInto(packet)
+    return packet
+
+  def _Layout(self):
+    """Returns the packet offsets of priority, sequence, options and levels.
+
+    options is None for V2, which has none.
+    """
+    # preamble, root PDU flags/length, vector and CID, framing flags/length
+    # and vector
+    framing_header = 16 + 2 + 4 + 16 + 2 + 4
+    levels = sacn.SACNReceiver._FRAMING_LAYER[self._protocol][1]
+    if self._protocol == self.PROTOCOL_V2:
+      # SourceName, Priority, SequenceNumber
+      priority = framing_header + 32
+      return priority, priority + 1, None, levels
+    # SourceName, Priority, Reserved, SequenceNumber, Options
+    priority = framing_header + 64
+    return priority, priority + 3, priority + 4, levels
+
+class _UniversePacket(object):
+  """A universe's data packet and where to patch it."""
+
+  def __init__(self, data, layout, addrs):
+    self.data = data
+    self.addrs = addrs
+    self._priority, self._sequence, self._options, self._levels = layout
+    self._levels_view = memoryview(data)[self._levels:]
+    self._next_sequence = 0
+
+  def SetLevels(self, levels):
+    count = min(len(levels), len(self._levels_view))
+    self._levels_view[:count] = levels[:count]
+    if count < len(self._levels_view):
+      self._levels_view[count:] = _ZERO_LEVELS[count:len(self._levels_view)]
+
+  def SetPriority(self, priority):
+    self.data[self._priority] = priority
+
+  def SetOption(self, option):
+    if self._options is not None:
+      self.data[self._options] |= option
+
+  def Next(self):
+    """Numbers the packet for its next send and returns it."""
+    self.data[self._sequence] = self._next_sequence
+    self._next_sequence = (self._next_sequence + 1) & 0xFF
+    return self.data
+
+if __name__ == "__main__":
+  import argparse
+  import sys
+  import time
+  logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--universes", type=int, nargs="+", default=[1,2,3,4])
+  parser.add_argument("--count", type=int, default=None,
+                      help="send universes 1 to this instead")
+  parser.add_argument("--rate", type=float, default=44)
+  parser.add_argument("--dest", default=None,
+                      help="send every universe here instead of multicast")
+  parser.add_argument("--seconds", type=float, default=None,
+                      help="stop after this long instead of running until ^C")
+  args = parser.parse_args()
+
+  universes = args.universes
+  if args.count:
+    universes = range(1, args.count + 1)
+  sender = SACNSender(universes=universes, dest=args.dest,
+                      frame_rate=args.rate)
+  start = time.time()
+  try:
+    while args.seconds is None or time.time() - start < args.seconds:
+      time.sleep(1)
+      # fade every universe so that receivers see the levels change
+      level = int(time.time() - start) * 16 & 0xFF
+      for universe in universes:
+        sender.SetLevels(universe, chr(level) * SACNSender.CHANNELS)
+      stats = sender.Stats(reset=True)
+      logging.info("sent %.1f packets/s, busy max %.1f ms, overruns %d, "
+                   "errors %d", stats["ticks"] * len(universes),
+                   stats["busy_max_ms"], stats["overruns"],
+                   sender.SendErrors(reset=True))
+  finally:
+    sender.Close()
@@ -1,63 +1,466 @@
+import errno
 import logging
+import os
+import re
+import scheduler
 import serial
+import struct
+import threading
 import time
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Bytes the host may send instead of a universe byte 0-3, and the reply to
+# PROTOCOL_QUERY; see leonardo_firmware/avrdmx.h.
+PROTOCOL_QUERY = 0xFE
+PROTOCOL_QUERY_FILLER = 449
+PROTOCOL_BULK_FRAME = 0xFF
+PROTOCOL_SPANS = 0xFD
+PROTOCOL_SPAN_RUN = 0x8000
+PROTOCOL_REPLY = 0x80
+PROTOCOL_FEATURE_BULK = 0x01
+PROTOCOL_FEATURE_SPANS = 0x02
+
+# start channel and length of a span in a PROTOCOL_SPANS record
+_SPAN = struct.Struct("!HH")
+# shorter runs cost more as their own span than as part of a literal one
+_MIN_RUN = 8
+_RUN = re.compile(r"(.)\1{%d,}" % (_MIN_RUN - 1), re.S)
 
 class SerialDmx(object):
-  def __init__(self, port=None, set_dtr=True):
+  _CHANNELS = 512
+  _BOARD_UNIVERSES = 4
+  # a universe byte followed by its levels
+  _RECORD_SIZE = _CHANNELS + 1
+  # PROTOCOL_BULK_FRAME followed by the interleaved levels of all universes
+  _BULK_SIZE = _BOARD_UNIVERSES * _CHANNELS + 1
+  _QUERY_TIMEOUT = 0.5
+  # granularity of the comparison with the levels last sent
+  _DIFF_BLOCK = 32
+
+  def __init__(self, port=None, set_dtr=True, delta=False,
+               refresh_interval=1.0, max_backlog=None, event_loop=None,
+               bulk=False, spans=False, serial_port=None):
+    """Opens the port.
+
+    serial_port is an already open serial.Serial, or an object with the same
+    methods, to write to instead of opening port.
+
+    With bulk, the firmware is asked whether it accepts bulk frames, and if it
+    does, SendUniverses writes all four universes as one frame that is already
+    interleaved the way the firmware stores them.
+
+    With spans, the firmware is asked whether it accepts span records, and if
+    it does, SendUniverses writes each universe as spans of the levels that
+    changed since the last write, with runs of equal levels collapsed, unless
+    a plain record or a bulk frame is smaller.
+
+    With an eventloop.EventLoop, the port is written without blocking: what
+    does not fit in the OS buffer is written by the loop once the port is
+    writable, and frames sent until then are dropped. This needs a POSIX
+    system; elsewhere the port is written blocking as usual.
+    """
     self._set_dtr = set_dtr
-    self._port = serial.Serial(port=port, dsrdtr=set_dtr)
+    self._max_backlog = max_backlog
+    self._dropped_frames = 0
+    self._delta = delta
+    self._refresh_interval = refresh_interval
+    self._last_refresh = None
+    self._sent = {}
+    self._snapshots = {}
+    self._frame = bytearray()
+    self._frame_view = memoryview(self._frame)
+    if serial_port is None:
+      serial_port = serial.Serial(port=port, dsrdtr=set_dtr)
+    self._port = serial_port
     if set_dtr:
       self._port.setDTR(True)
+
+    features = 0
+    if bulk or spans:
+      features = self._QueryFeatures()
+    self._bulk = None
+    if bulk:
+      if features & PROTOCOL_FEATURE_BULK:
+        self._bulk = bytearray(self._BULK_SIZE)
+        self._bulk[0] = PROTOCOL_BULK_FRAME
+        self._bulk_view = memoryview(self._bulk)
+      else:
+        logging.warning("Firmware on %s does not take bulk frames, sending "
+                        "universes one at a time", port)
+    self._spans = False
+    if spans:
+      if features & PROTOCOL_FEATURE_SPANS:
+        self._spans = True
+      else:
+        logging.warning("Firmware on %s does not take span records, sending "
+                        "whole universes", port)
+
+    self._event_loop = None
+    self._lock = threading.Lock()
+    self._pending = None
+    self._write_error = None
+    if event_loop is not None:
+      if fcntl is None:
+        logging.warning("Non-blocking serial output is not supported here")
+      else:
+        fd = self._port.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._event_loop = event_loop
     logging.info("Opened %s for writing DMX data", port)
 
   def Close(self):
+    if self._event_loop:
+      self._event_loop.RemoveWriter(self._port)
     if self._set_dtr:
       self._port.setDTR(False)
     self._port.close()
     logging.info("Closed DMX output serial port")
 
   def SendChannels(self, channels, universe=1):
-    universe_byte = bytes(chr(universe - 1))
-    logging.debug("universe byte: %s", ord(universe_byte))
-    assert len(channels) == 512
-    logging.debug("channels: %d %s", len(channels), [ord(c) for c in channels])
-    self._port.write(universe_byte + channels)
+    if self._Busy():
+      return
+    frame = self._Frame(1)
+    self._Assemble(0, universe, channels)
+    self._Write(frame[:self._RECORD_SIZE])
 
   def SendUniverses(self, universes):
-    buf = bytes()
+    """Writes the universes in one transfer and returns the ones written.
+
+    In delta mode, a universe whose levels match what was last written is
+    skipped, except that every universe is written again once per
+    refresh_interval seconds in case the board missed or dropped something.
+    Span records are likewise sent in full once per refresh_interval.
+
+    With max_backlog set, nothing is written while more than that many frames
+    of this size are still queued for the port, so that a slow link does not
+    build up latency. The caller passes the newest levels every time, so the
+    next frame that goes out catches up on what was dropped.
+    """
+    if self._Busy():
+      return []
+    if self._max_backlog is not None:
+      if self._bulk is not None:
+        backlog = self._max_backlog * self._BULK_SIZE
+      else:
+        backlog = self._max_backlog * len(universes) * self._RECORD_SIZE
+      if self.OutWaiting() > backlog:
+        self._dropped_frames += 1
+        logging.debug("Output backlog over %d bytes, dropped frame", backlog)
+        return []
+
+    # span records are encoded against the last written levels too
+    track = self._delta or self._spans
+    refresh = True
+    if track:
+      now = scheduler.monotonic()
+      refresh = (self._last_refresh is None or
+                 now - self._last_refresh >= self._refresh_interval)
+      if refresh:
+        self._last_refresh = now
+      # the caller's buffers may change while this runs, so the comparison,
+      # the frame and the record of what was sent all use one copy
+      universes = self._Snapshot(universes)
+
+    written = []
     for universe, channels in universes.iteritems():
-      universe_byte = bytes(chr(universe - 1))
-      logging.debug("universe byte: %s", ord(universe_byte))
-      buf += universe_byte
-      assert len(channels) == 512
-      logging.debug("channels: %d %s", len(channels),
-                    [ord(c) for c in channels])
-      buf += channels
-    self._port.write(buf)
+      if refresh or not self._delta or self._sent.get(universe) != channels:
+        written.append(universe)
+    if written and self._spans:
+      frame = self._Frame(len(written))
+      offset = 0
+      for universe in written:
+        channels = universes[universe]
+        previous = None if refresh else self._sent.get(universe)
+        end = self._AssembleSpans(offset, universe, channels, previous)
+        if end is None:
+          self._Assemble(offset, universe, channels)
+          end = offset + self._RECORD_SIZE
+        offset = end
+      if self._bulk is not None and offset > self._BULK_SIZE:
+        self._Write(self._AssembleBulk(universes))
+      else:
+        self._Write(frame[:offset])
+    elif written and self._bulk is not None:
+      self._Write(self._AssembleBulk(universes))
+    elif written:
+      frame = self._Frame(len(written))
+      offset = 0
+      for universe in written:
+        self._Assemble(offset, universe, universes[universe])
+        offset += self._RECORD_SIZE
+      self._Write(frame[:offset])
 
-if __name__ == "__main__":
-  import os
-  from ctypes import *
+    if track:
+      for universe in written:
+        sent = self._sent.get(universe)
+        if sent is None:
+          sent = self._sent[universe] = bytearray(self._CHANNELS)
+        sent[:] = universes[universe]
+    return written
+
+  def OutWaiting(self):
+    """Returns the number of bytes queued for the port, if it can tell."""
+    pending = self._pending
+    queued = len(pending) if pending is not None else 0
+    if hasattr(self._port, 'out_waiting'):
+      return queued + self._port.out_waiting
+    elif hasattr(self._port, 'outWaiting'):
+      return queued + self._port.outWaiting()
+    else:
+      return queued
+
+  def DroppedFrames(self, reset=False):
+    """Returns the number of frames dropped because of the backlog."""
+    dropped = self._dropped_frames
+    if reset:
+      self._dropped_frames = 0
+    return dropped
+
+  def _Busy(self):
+    """Returns whether a non-blocking write is still in progress.
+
+    Raises the error of a non-blocking write that failed since the last call.
+    """
+    if self._event_loop is None:
+      return False
+    with self._lock:
+      error = self._write_error
+      self._write_error = None
+      busy = self._pending is not None
+    if error:
+      raise error
+    if busy:
+      self._dropped_frames += 1
+    return busy
 
-  serial_dmx = SerialDmx(port="/dev/ptmx", set_dtr=False)
-  master_fd = serial_dmx._port.fileno()
+  def _Write(self, data):
+    if self._event_loop is None:
+      self._port.write(data)
+      return
+    with self._lock:
+      count = self._WriteSome(data)
+      if count < len(data):
+        # the output buffer stays untouched until this has been written, as
+        # frames are dropped meanwhile
+        self._pending = data[count:]
+        self._event_loop.AddWriter(self._port, self._OnWritable)
 
-  libc = CDLL("libc.so.6")
-  libc.unlockpt(master_fd)
-  libc.ptsname.restype = c_char_p
-  ptsname = libc.ptsname(master_fd)
-  slave = os.open(ptsname, os.O_RDONLY)
+  def _WriteSome(self, data):
+    try:
+      return os.write(self._port.fileno(), data)
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return 0
+      raise serial.SerialException("Write failed: %s" % e)
 
-  serial_dmx.SendChannels(bytearray([2,4,6,8]))
-  serial_dmx.SendChannels(bytearray([10,11,12,17]))
+  def _OnWritable(self):
+    with self._lock:
+      if self._pending is not None:
+        try:
+          count = self._WriteSome(self._pending)
+        except serial.SerialException, e:
+          logging.error("DMX output failed: %s", e)
+          self._write_error = e
+          count = len(self._pending)
+        if count < len(self._pending):
+          self._pending = self._pending[count:]
+          return
+        self._pending = None
+      self._event_loop.RemoveWriter(self._port)
 
+  def _QueryFeatures(self):
+    """Returns the PROTOCOL_FEATURE_* flags that the firmware supports.
+
+    Firmware that predates the query does not reply, and stores the filler as
+    levels of universe 3 from channel 64 on, until the next frame.
+    """
+    timeout = self._port.timeout
+    self._port.timeout = self._QUERY_TIMEOUT
+    try:
+      self._port.write(bytearray([PROTOCOL_QUERY]) +
+                       bytearray(PROTOCOL_QUERY_FILLER))
+      reply = self._port.read(1)
+    finally:
+      self._port.timeout = timeout
+    if not reply or not ord(reply) & PROTOCOL_REPLY:
+      return 0
+    return ord(reply) & ~PROTOCOL_REPLY
+
+  def _Snapshot(self, universes):
+    """Copies the universes' levels into buffers kept for the next call."""
+    snapshot = {}
+    for universe, channels in universes.iteritems():
+      levels = self._snapshots.get(universe)
+      if levels is None:
+        levels = self._snapshots[universe] = bytearray(self._CHANNELS)
+      levels[:] = channels
+      snapshot[universe] = levels
+    return snapshot
+
+  def _AssembleBulk(self, universes):
+    """Interleaves the universes into the bulk frame and returns it.
+
+    Universes that are not given keep their levels from the previous frame.
+    """
+    bulk = self._bulk
+    for universe, channels in universes.iteritems():
+      assert len(channels) == self._CHANNELS
+      assert 1 <= universe <= self._BOARD_UNIVERSES
+      # one strided copy per universe, as _chandata[channel * 4 + universe]
+      bulk[universe::self._BOARD_UNIVERSES] = channels
+    return self._bulk_view
+
+  def _AssembleSpans(self, offset, universe, levels, previous=None):
+    """Writes levels as a PROTOCOL_SPANS record at offset.
+
+    Only the levels that differ from previous are encoded, or all of them
+    without previous. levels must be a bytearray that does not change
+    meanwhile, such as one from _Snapshot. Returns the end of the record, or
+    None if it would not be smaller than a plain record.
+    """
+    assert len(levels) == self._CHANNELS
+    levels_view = memoryview(levels)
+    frame = self._frame
+    limit = offset + self._RECORD_SIZE
+    position = offset + 3
+    count = 0
+    for start, end in self._ChangedRegions(levels, previous):
+      for span_start, span_end, run in _Spans(levels, start, end):
+        length = span_end - span_start
+        size = _SPAN.size + (1 if run else length)
+        count += 1
+        if position + size >= limit or count > 0xFF:
+          return None
+        _SPAN.pack_into(frame, position, span_start,
+                        length | PROTOCOL_SPAN_RUN if run else length)
+        position += _SPAN.size
+        if run:
+          frame[position] = levels[span_start]
+        else:
+          self._frame_view[position:position + length] = (
+              levels_view[span_start:span_end])
+        position += size - _SPAN.size
+    frame[offset] = PROTOCOL_SPANS
+    frame[offset + 1] = universe - 1
+    frame[offset + 2] = count
+    return position
+
+  def _ChangedRegions(self, levels, previous):
+    """Returns the [start, end) ranges of levels that differ from previous."""
+    if previous is None:
+      return [(0, self._CHANNELS)]
+    if levels == previous:
+      return []
+    regions = []
+    block = self._DIFF_BLOCK
+    for start in xrange(0, self._CHANNELS, block):
+      if levels[start:start + block] == previous[start:start + block]:
+        continue
+      if regions and regions[-1][1] == start:
+        regions[-1][1] = start + block
+      else:
+        regions.append([start, start + block])
+    # trim the unchanged levels at the edges of each region
+    for region in regions:
+      while levels[region[0]] == previous[region[0]]:
+        region[0] += 1
+      while levels[region[1] - 1] == previous[region[1] - 1]:
+        region[1] -= 1
+    return regions
+
+  def _Frame(self, universe_count):
+    """Returns a view of the output buffer, grown to fit universe_count."""
+    size = universe_count * self._RECORD_SIZE
+    if len(self._frame) < size:
+      self._frame = bytearray(size)
+      self._frame_view = memoryview(self._frame)
+    return self._frame_view
+
+  def _Assemble(self, offset, universe, channels):
+    """Writes one universe byte and its levels into the output buffer."""
+    assert len(channels) == self._CHANNELS
+    self._frame[offset] = universe - 1
+    self._frame_view[offset + 1:offset + self._RECORD_SIZE] = channels
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      logging.debug("universe byte: %d", universe - 1)
+      logging.debug("channels: %d %s", len(channels),
+                    list(bytearray(channels)))
+
+def _Spans(levels, start, end):
+  """Yields (start, end, run) spans of levels[start:end].
+
+  Runs of _MIN_RUN or more equal levels are found with one regular
+  expression scan and become run spans; the rest become literal spans.
+  """
+  literal = start
+  for match in _RUN.finditer(levels, start, end):
+    if match.start() > literal:
+      yield literal, match.start(), False
+    yield match.start(), match.end(), True
+    literal = match.end()
+  if end > literal:
+    yield literal, end, False
+
+if __name__ == "__main__":
+  # sends changing levels to an emulated board and reports what it received
+  import argparse
+  import avrdmxemulator
+  import sys
+  logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--seconds", type=float, default=5.0)
+  parser.add_argument("--rate", type=float, default=avrdmxemulator.FRAME_RATE,
+                      help="frames sent per second")
+  parser.add_argument("--universes", type=int, default=4)
+  parser.add_argument("--delta", action="store_true")
+  parser.add_argument("--bulk", action="store_true")
+  parser.add_argument("--spans", action="store_true")
+  parser.add_argument("--sparse", action="store_true",
+                      help="change a few channels over a dark universe")
+  parser.add_argument("--old-firmware", action="store_true",
+                      help="emulate firmware without the query and bulk frames")
+  args = parser.parse_args()
+
+  if args.old_firmware:
+    emulator = avrdmxemulator.AvrDmxEmulator(features=0, query=False)
+  else:
+    emulator = avrdmxemulator.AvrDmxEmulator()
+  serial_dmx = SerialDmx(port=emulator.PortName(), set_dtr=False,
+                         delta=args.delta, bulk=args.bulk, spans=args.spans)
+  universes = dict([(universe, bytearray(512))
+                    for universe in xrange(1, args.universes + 1)])
+  frame = [0]
+  def Send():
+    frame[0] += 1
+    for universe, channels in universes.iteritems():
+      level = chr((frame[0] + universe) & 0xFF)
+      if args.sparse:
+        channels[universe * 10:universe * 10 + 6] = level * 6
+      else:
+        channels[:] = level * 512
+    serial_dmx.SendUniverses(universes)
+  output_scheduler = scheduler.FrameScheduler(Send, args.rate)
+  mismatches = 0
   try:
-    while True:
-      bytes = os.read(slave, 16)
-      if len(bytes) > 0:
-        for c in bytes:
-          print "%x " % ord(c),
-        print
+    start = time.time()
+    while time.time() - start < args.seconds:
+      time.sleep(1)
+      logging.info(emulator.Report(reset=True))
   finally:
-    os.close(slave)
+    output_scheduler.Close()
+    # let the last frame reach the line before comparing
+    time.sleep(0.1)
+    for universe, channels in sorted(universes.iteritems()):
+      if emulator.Levels(universe) != channels:
+        logging.error("U%d levels on the line differ from the last sent",
+                      universe)
+        mismatches += 1
     serial_dmx.Close()
+    emulator.Close()
+  # fail the run, so that this can serve as a regression check
+  if mismatches:
+    sys.exit(1)
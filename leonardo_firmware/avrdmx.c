@@ -70,6 +70,116 @@ extern uint8_t _chandata[2048];
 
 extern void InitDMXOut(void);
 
+// Copies up to length bytes that are waiting in the CDC OUT endpoint to dest
+// and returns how many were copied. This is CDC_Device_ReceiveByte for a whole
+// endpoint bank at a time.
+static uint16_t ReceiveBlock(uint8_t* dest, uint16_t length) {
+  if ((USB_DeviceState != DEVICE_STATE_Configured) ||
+      !(VirtualSerial_CDC_Interface.State.LineEncoding.BaudRateBPS)) {
+    return 0;
+  }
+
+  uint16_t received = 0;
+  Endpoint_SelectEndpoint(
+      VirtualSerial_CDC_Interface.Config.DataOUTEndpoint.Address);
+  if (Endpoint_IsOUTReceived()) {
+    while (received < length && Endpoint_BytesInEndpoint()) {
+      dest[received++] = Endpoint_Read_8();
+    }
+    if (!Endpoint_BytesInEndpoint()) {
+      Endpoint_ClearOUT();
+    }
+  }
+  return received;
+}
+
+// Receives a PROTOCOL_BULK_FRAME: the host has already interleaved the
+// universes, so the bytes go straight into _chandata in order.
+static void ReceiveBulkFrame(void) {
+  uint16_t received = 0;
+  while (received < 2048) {
+    uint16_t count = ReceiveBlock(_chandata + received, 2048 - received);
+    if (count == 0 && !connected) {
+      // connection lost, forget our position and wait for a connection
+      return;
+    }
+    received += count;
+  }
+}
+
+// Waits for the next byte from the host. Returns -1 if the connection is lost
+// meanwhile.
+static int16_t ReceiveByteWaiting(void) {
+  while (true) {
+    int16_t received = CDC_Device_ReceiveByte(&VirtualSerial_CDC_Interface);
+    if (received != -1 || !connected) {
+      return received;
+    }
+  }
+}
+
+// Receives a PROTOCOL_SPANS record and stores the levels of its spans.
+static void ReceiveSpans(void) {
+  int16_t universe = ReceiveByteWaiting();
+  int16_t count = ReceiveByteWaiting();
+  if (universe == -1 || count == -1) {
+    return;
+  }
+
+  while (count-- > 0) {
+    uint8_t header[4];
+    for (uint8_t i = 0; i < 4; i++) {
+      int16_t received = ReceiveByteWaiting();
+      if (received == -1) {
+        return;
+      }
+      header[i] = received;
+    }
+    uint16_t start = (header[0] << 8) | header[1];
+    uint16_t length = (header[2] << 8) | header[3];
+    bool run = length & PROTOCOL_SPAN_RUN;
+    length &= ~PROTOCOL_SPAN_RUN;
+    // a span outside the universe is received, but not stored
+    bool valid = universe < 4 && start + length <= 512;
+    uint8_t* position = _chandata + start * 4 + universe;
+
+    int16_t level = 0;
+    if (run) {
+      level = ReceiveByteWaiting();
+      if (level == -1) {
+        return;
+      }
+    }
+    for (uint16_t i = 0; i < length; i++) {
+      if (!run) {
+        level = ReceiveByteWaiting();
+        if (level == -1) {
+          return;
+        }
+      }
+      if (valid) {
+        *position = (uint8_t)level;
+        position += 4;
+      }
+    }
+  }
+}
+
+// Answers a PROTOCOL_QUERY and skips the filler that follows it.
+static void ReplyToQuery(void) {
+  CDC_Device_SendByte(&VirtualSerial_CDC_Interface, PROTOCOL_FEATURES);
+  CDC_Device_Flush(&VirtualSerial_CDC_Interface);
+
+  uint16_t filler = PROTOCOL_QUERY_FILLER;
+  while (filler > 0) {
+    if (CDC_Device_ReceiveByte(&VirtualSerial_CDC_Interface) != -1) {
+      filler--;
+    } else if (!connected) {
+      return;
+    }
+  }
+}
+
 int main(void) {
   SetupHardware();
 
@@ -95,6 +205,18 @@ int main(void) {
         // just a normal timeout, continue
         continue;
       }
+      if (universe == PROTOCOL_QUERY) {
+        ReplyToQuery();
+        continue;
+      }
+      if (universe == PROTOCOL_BULK_FRAME) {
+        ReceiveBulkFrame();
+        continue;
+      }
+      if (universe == PROTOCOL_SPANS) {
+        ReceiveSpans();
+        continue;
+      }
       position += universe;
 
       while (position < _chandata + 2048) {
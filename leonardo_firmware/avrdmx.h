@@ -62,6 +62,38 @@
 		/** LED mask for the library LED driver, to indicate that an error has occurred in the USB interface. */
 		#define LEDMASK_USB_ERROR        (LEDS_LED2 | LEDS_LED3)
 
+		/** Sent by the host instead of a universe byte to ask for PROTOCOL_FEATURES. */
+		#define PROTOCOL_QUERY            0xFE
+
+		/** Filler bytes that follow PROTOCOL_QUERY. Firmware without query support takes the query for a
+		 *  universe byte and reads this many levels, so the filler keeps it in step with the host.
+		 */
+		#define PROTOCOL_QUERY_FILLER     449
+
+		/** Sent by the host instead of a universe byte, followed by a whole interleaved _chandata image. */
+		#define PROTOCOL_BULK_FRAME       0xFF
+
+		/** Sent by the host instead of a universe byte, followed by a universe byte, a span count and that many
+		 *  spans. A span is a 16-bit big-endian start channel and length, followed by the levels, or by a single
+		 *  level for all of the span if the length has PROTOCOL_SPAN_RUN set. Other channels keep their levels.
+		 */
+		#define PROTOCOL_SPANS            0xFD
+
+		/** Flag in the length of a PROTOCOL_SPANS span whose channels all take one level. */
+		#define PROTOCOL_SPAN_RUN         0x8000
+
+		/** Reply to PROTOCOL_QUERY: PROTOCOL_REPLY or'ed with the PROTOCOL_FEATURE_* flags supported. */
+		#define PROTOCOL_REPLY            0x80
+
+		/** Feature flag for PROTOCOL_BULK_FRAME support. */
+		#define PROTOCOL_FEATURE_BULK     0x01
+
+		/** Feature flag for PROTOCOL_SPANS support. */
+		#define PROTOCOL_FEATURE_SPANS    0x02
+
+		/** Features of this firmware, as reported to PROTOCOL_QUERY. */
+		#define PROTOCOL_FEATURES         (PROTOCOL_REPLY | PROTOCOL_FEATURE_BULK | PROTOCOL_FEATURE_SPANS)
+
 	/* Function Prototypes: */
 		void SetupHardware(void);
 
@@ -0,0 +1,163 @@
+# Measures how long level changes take from the network to the serial port.
+# Each universe frame is timestamped when its datagram is read, when it has
+# been parsed, when the listener callback hands it to the driver, and when
+# SerialDmx writes it:
+#
+#   parse    received -> parsed
+#   handoff  parsed -> handed to the driver
+#   write    handed to the driver -> written, mostly waiting for the next tick
+#   total    received -> written
+#
+# The times come from scheduler.monotonic and are collected into histograms
+# per universe and stage.
+
+import math
+import scheduler
+import threading
+
+STAGES = ("parse", "handoff", "write", "total")
+
+class LatencyHistogram(object):
+  """Counts latencies in log-scale buckets, four per doubling from 0.1 ms.
+
+  Percentiles are reported as the upper bound of their bucket, so they are
+  at most 19% high. Latencies past the last bucket land in it and are
+  reported as the maximum.
+  """
+  _FIRST_MS = 0.1
+  _BUCKETS_PER_DOUBLING = 4
+  # up to 0.1 ms * 2 ** 17, about 13 seconds
+  _BUCKET_COUNT = 17 * _BUCKETS_PER_DOUBLING + 1
+
+  def __init__(self):
+    self._buckets = [0] * self._BUCKET_COUNT
+    self._count = 0
+    self._max = 0.0
+
+  def Add(self, seconds):
+    ms = seconds * 1000
+    if ms <= self._FIRST_MS:
+      bucket = 0
+    else:
+      bucket = min(self._BUCKET_COUNT - 1,
+                   int(math.ceil(math.log(ms / self._FIRST_MS, 2) *
+                                 self._BUCKETS_PER_DOUBLING)))
+    self._buckets[bucket] += 1
+    self._count += 1
+    self._max = max(self._max, ms)
+
+  def Count(self):
+    return self._count
+
+  def Max(self):
+    """Returns the largest latency added, in milliseconds."""
+    return self._max
+
+  def Percentile(self, percent):
+    """Returns the latency in milliseconds that percent of the adds were under.
+
+    Returns 0.0 if nothing was added.
+    """
+    if not self._count:
+      return 0.0
+    rank = int(math.ceil(self._count * percent / 100.0)) or 1
+    seen = 0
+    for bucket, count in enumerate(self._buckets):
+      seen += count
+      if seen >= rank and bucket < self._BUCKET_COUNT - 1:
+        return min(self._max, self._BucketLimit(bucket))
+    return self._max
+
+  def _BucketLimit(self, bucket):
+    return self._FIRST_MS * 2 ** (float(bucket) / self._BUCKETS_PER_DOUBLING)
+
+class LatencyTracker(object):
+  """Pairs the receive and write times of universe frames.
+
+  Handoff is called from the listener callback and Written from the output
+  thread. A universe that is handed off several times before it is written
+  is measured from its newest frame, which is the one that gets written.
+  Writes without a handoff since the previous one, such as refreshes, are
+  not measured.
+  """
+  PERCENTILES = (50, 90, 99)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._pending = {}
+    self.ResetStats()
+
+  def Handoff(self, universe, receive_times):
+    """Notes that a universe frame reached the driver.
+
+    receive_times is (received, parsed) as returned by the listener's
+    ReceiveTimes, or None if it has none, in which case the frame is not
+    measured. Only hand off frames whose levels changed, as delta output
+    holds back the others until its next refresh.
+    """
+    if receive_times is None:
+      return
+    received, parsed = receive_times
+    with self._lock:
+      self._pending[universe] = (received, parsed, scheduler.monotonic())
+
+  def Written(self, universes):
+    """Notes that the newest frames of universes were written."""
+    now = scheduler.monotonic()
+    with self._lock:
+      for universe in universes:
+        times = self._pending.pop(universe, None)
+        if times is None:
+          continue
+        received, parsed, handoff = times
+        histograms = self._histograms.get(universe)
+        if histograms is None:
+          histograms = dict([(stage, LatencyHistogram()) for stage in STAGES])
+          self._histograms[universe] = histograms
+        histograms["parse"].Add(parsed - received)
+        histograms["handoff"].Add(handoff - parsed)
+        histograms["write"].Add(now - handoff)
+        histograms["total"].Add(now - received)
+
+  def Stats(self, reset=False):
+    """Returns the latencies measured since the last reset.
+
+    The result maps each universe to a dict per stage with count, p50, p90,
+    p99 and max, all in milliseconds.
+    """
+    with self._lock:
+      stats = {}
+      for universe, histograms in self._histograms.iteritems():
+        stats[universe] = dict([(stage, _Summary(histogram))
+                                for stage, histogram in histograms.iteritems()])
+      if reset:
+        self._histograms = {}
+    return stats
+
+  def ResetStats(self):
+    with self._lock:
+      self._histograms = {}
+
+  def Report(self, reset=False):
+    """Returns the stats formatted for logging."""
+    stats = self.Stats(reset=reset)
+    if not stats:
+      return "no frames measured"
+    parts = []
+    for universe in sorted(stats):
+      stages = stats[universe]
+      total = stages["total"]
+      parts.append(
+          "U%d n=%d total p50/p90/p99/max=%.1f/%.1f/%.1f/%.1fms "
+          "p90 parse/handoff/write=%.2f/%.2f/%.1fms" %
+          (universe, total["count"], total["p50"], total["p90"],
+           total["p99"], total["max"], stages["parse"]["p90"],
+           stages["handoff"]["p90"], stages["write"]["p90"]))
+    return " | ".join(parts)
+
+def _Summary(histogram):
+  summary = {"count": histogram.Count(),
+             "max": round(histogram.Max(), 2)}
+  for percent in LatencyTracker.PERCENTILES:
+    summary["p%d" % percent] = round(histogram.Percentile(percent), 2)
+  return summary
@@ -1,6 +1,10 @@
+import eventloop
+import latency
 import logging
 import midi
 import sacn
+import sacncapture
+import scheduler
 import serialdmx
 import sys
 from PyQt4 import QtCore
@@ -50,6 +54,11 @@ class BlinkLight(QtGui.QWidget):
         self._label)
 
 class MainWindow(QtGui.QWidget):
+  # DMX output runs on the scheduler thread, so the universes it wrote and its
+  # errors are reported to the GUI thread through these signals
+  _dmxWritten = QtCore.pyqtSignal(list)
+  _dmxFailed = QtCore.pyqtSignal(str)
+
   def __init__(self):
     super(MainWindow, self).__init__()
 
@@ -57,10 +66,17 @@ class MainWindow(QtGui.QWidget):
 
     self._sacn = None
     self._dmx = None
-    self._dmxTimer = None
+    self._dmxScheduler = None
+    # read from the widgets when the output is turned on, for the scheduler
+    # thread to reopen the port with
+    self._dmxOptions = None
+    self._dmxRetryEnabled = False
+    # serves the sACN socket and the non-blocking serial port
+    self._eventLoop = eventloop.EventLoop('avrdmx')
     self._midi = None
     self._display = False
     self._universeData = {}
+    self._latency = latency.LatencyTracker()
 
     self.setWindowTitle('avrdmx Control Panel')
 
@@ -84,6 +100,10 @@ class MainWindow(QtGui.QWidget):
       self._dmxLights.append(l)
     self._dmxOutWaiting = QtGui.QLabel('outbuf=0', self)
     hbox.addWidget(self._dmxOutWaiting)
+    self._dmxTiming = QtGui.QLabel('jitter=0.0ms overruns=0', self)
+    hbox.addWidget(self._dmxTiming)
+    self._dmxLatency = QtGui.QLabel('latency p50=0.0ms p99=0.0ms', self)
+    hbox.addWidget(self._dmxLatency)
     hbox.addStretch(1)
 
     self._midiLight = BlinkLight('MIDI Out', self)
@@ -153,6 +173,12 @@ class MainWindow(QtGui.QWidget):
     configHbox.addWidget(self._sacnUniverseOffset)
     configVbox.addLayout(configHbox)
 
+    configHbox = QtGui.QHBoxLayout()
+    configHbox.addWidget(QtGui.QLabel('Replay capture', self._sacnConfig))
+    self._sacnReplayPath = QtGui.QLineEdit('', self._sacnConfig)
+    configHbox.addWidget(self._sacnReplayPath)
+    configVbox.addLayout(configHbox)
+
     self._sacnConfig.setLayout(configVbox)
     hbox.addWidget(self._sacnConfig)
 
@@ -188,6 +214,28 @@ class MainWindow(QtGui.QWidget):
     self._dmxRetry.setChecked(True)
     configVbox.addWidget(self._dmxRetry)
 
+    self._dmxDelta = QtGui.QCheckBox('Send changes only', self._dmxConfig)
+    self._dmxDelta.setChecked(True)
+    configVbox.addWidget(self._dmxDelta)
+
+    self._dmxBulk = QtGui.QCheckBox('Bulk frames', self._dmxConfig)
+    self._dmxBulk.setChecked(False)
+    configVbox.addWidget(self._dmxBulk)
+
+    self._dmxSpans = QtGui.QCheckBox('Compact frames', self._dmxConfig)
+    self._dmxSpans.setChecked(False)
+    configVbox.addWidget(self._dmxSpans)
+
+    configHbox = QtGui.QHBoxLayout()
+    configHbox.addWidget(QtGui.QLabel('Drop frames over', self._dmxConfig))
+    self._dmxMaxBacklog = QtGui.QSpinBox(self._dmxConfig)
+    self._dmxMaxBacklog.setRange(0, 16)
+    self._dmxMaxBacklog.setValue(1)
+    self._dmxMaxBacklog.setSpecialValueText('Never')
+    self._dmxMaxBacklog.setSuffix(' queued')
+    configHbox.addWidget(self._dmxMaxBacklog)
+    configVbox.addLayout(configHbox)
+
     self._dmxConfig.setLayout(configVbox)
     hbox.addWidget(self._dmxConfig)
 
@@ -289,17 +337,24 @@ class MainWindow(QtGui.QWidget):
     self.setLayout(vbox)
     self.show()
 
+    self._dmxWritten.connect(self._onDmxWritten)
+    self._dmxFailed.connect(self._onDmxFailed)
+
     self._guiTimer = QtCore.QTimer(self)
     self._guiTimer.timeout.connect(self._onGuiTimer)
     self._guiTimer.start(500)
 
   def closeEvent(self, event):
+    if self._dmxScheduler:
+      self._dmxScheduler.Close()
+      self._dmxScheduler = None
     if self._sacn:
       self._sacn.Close()
       self._sacn = None
     if self._dmx:
       self._dmx.Close()
       self._dmx = None
+    self._eventLoop.Close()
 
   def _onGuiTimer(self):
     with QtCore.QMutexLocker(self._mutex):
@@ -309,7 +364,21 @@ class MainWindow(QtGui.QWidget):
         l.deactivate()
       if self._dmx:
         self._dmxOutWaiting.setText(
-            'outbuf=%d' % self._dmx.OutWaiting())
+            'outbuf=%d dropped=%d' % (self._dmx.OutWaiting(),
+                                      self._dmx.DroppedFrames(reset=True)))
+      if self._dmxScheduler:
+        stats = self._dmxScheduler.Stats(reset=True)
+        self._dmxTiming.setText(
+            'jitter=%.1fms overruns=%d' % (stats['jitter_max_ms'],
+                                           stats['overruns']))
+        # the slowest universe, the percentiles of each are logged
+        totals = [stages['total']
+                  for stages in self._latency.Stats(reset=True).itervalues()]
+        if totals:
+          self._dmxLatency.setText(
+              'latency p50=%.1fms p99=%.1fms' % (
+                  max([total['p50'] for total in totals]),
+                  max([total['p99'] for total in totals])))
       self._midiLight.deactivate()
 
   def _toggleSacn(self, enabled):
@@ -321,12 +390,22 @@ class MainWindow(QtGui.QWidget):
       elif self._sacnProtocol.currentText == 'V3':
         protocol = sacn.SACNListener.PROTOCOL_V3
       try:
-        sacnListener = sacn.SACNListener(
-            universes=range(1, UNIVERSES+1),
-            callback=self._receiveChannels,
-            protocol=protocol,
-            console_universe_offset=self._sacnUniverseOffset.value(),
-            intf=str(self._sacnIntf.text()))
+        replayPath = str(self._sacnReplayPath.text())
+        if replayPath:
+          sacnListener = sacncapture.SACNReplayer(
+              replayPath,
+              callback=self._receiveChannels,
+              universes=range(1, UNIVERSES+1),
+              repeat=True)
+        else:
+          sacnListener = sacn.SACNListener(
+              universes=range(1, UNIVERSES+1),
+              callback=self._receiveChannels,
+              protocol=protocol,
+              console_universe_offset=self._sacnUniverseOffset.value(),
+              intf=str(self._sacnIntf.text()),
+              coalesce=True,
+              event_loop=self._eventLoop)
         with QtCore.QMutexLocker(self._mutex):
           self._sacn = sacnListener
       except Exception, e:
@@ -347,19 +426,28 @@ class MainWindow(QtGui.QWidget):
   def _toggleDisplay(self, enabled):
     with QtCore.QMutexLocker(self._mutex):
       self._display = enabled
+      if enabled:
+        for universe in self._universeData.iterkeys():
+          self._updateDisplay(universe)
 
   def _toggleDmx(self, enabled):
     if enabled:
       self._dmxConfig.setDisabled(True)
+      self._dmxOptions = dict(
+          port=str(self._dmxPort.currentText()),
+          set_dtr=self._dmxSetDtr.isChecked(),
+          delta=self._dmxDelta.isChecked(),
+          max_backlog=self._dmxMaxBacklog.value() or None,
+          event_loop=self._eventLoop,
+          bulk=self._dmxBulk.isChecked(),
+          spans=self._dmxSpans.isChecked())
+      self._dmxRetryEnabled = self._dmxRetry.isChecked()
       try:
-        dmx = serialdmx.SerialDmx(
-            port=str(self._dmxPort.currentText()),
-            set_dtr=self._dmxSetDtr.isChecked())
+        dmx = serialdmx.SerialDmx(**self._dmxOptions)
         with QtCore.QMutexLocker(self._mutex):
           self._dmx = dmx
-          self._dmxTimer = QtCore.QTimer(self)
-          self._dmxTimer.timeout.connect(self._onDmxTimer)
-          self._dmxTimer.start(1000 / self._dmxFrameRate.value())
+        self._dmxScheduler = scheduler.FrameScheduler(
+            self._onDmxTick, self._dmxFrameRate.value(), name='DMXOutput')
       except Exception, e:
         msg = QtGui.QMessageBox(self)
         msg.setWindowTitle('Error')
@@ -368,12 +456,13 @@ class MainWindow(QtGui.QWidget):
         msg.exec_()
         self._dmxButton.setChecked(False)
     else:
+      # stop the scheduler outside the mutex, as its tick takes the mutex
+      if self._dmxScheduler:
+        self._dmxScheduler.Close()
+        self._dmxScheduler = None
       with QtCore.QMutexLocker(self._mutex):
         dmx = self._dmx
         self._dmx = None
-        if self._dmxTimer:
-          self._dmxTimer.stop()
-          self._dmxTimer = None
         self._dmxConfig.setDisabled(False)
       if dmx:
         dmx.Close()
@@ -410,9 +499,18 @@ class MainWindow(QtGui.QWidget):
         self._midiPort.setCurrentIndex(self._midiPort.count() - 1)
 
   def _receiveChannels(self, universe, channels):
+    # packets arriving before the listener is stored count as changes
+    sacnListener = self._sacn
+    changed = sacnListener is None or sacnListener.Changed(universe)
+    if changed and sacnListener is not None:
+      # unchanged frames may not be written until the next refresh
+      self._latency.Handoff(universe, sacnListener.ReceiveTimes(universe))
+    # the listener updates its universe store in place, so keep a copy
+    channels = channels.tobytes()
     with QtCore.QMutexLocker(self._mutex):
-      if self._midi:
+      if self._midi and changed:
         self._sendMidi(universe, channels)
+      previous = self._universeData.get(universe)
       self._universeData[universe] = channels
 
       if (self._dimmerCheckEnable.isChecked() and
@@ -423,10 +521,13 @@ class MainWindow(QtGui.QWidget):
           self._universeData[universe][chan+1:])
 
       self._sacnLights[universe-1].activate()
-      if self._display:
-        text = CHANNEL_DISPLAY_FORMAT.format(
-          *[ord(b) for b in self._universeData[universe]])
-        self._channelDisplays[universe-1].setText(text)
+      if self._display and self._universeData[universe] != previous:
+        self._updateDisplay(universe)
+
+  def _updateDisplay(self, universe):
+    text = CHANNEL_DISPLAY_FORMAT.format(
+      *[ord(b) for b in self._universeData[universe]])
+    self._channelDisplays[universe-1].setText(text)
 
   def _sendMidi(self, universe, channels):
     midiUniverse = self._midiUniverse.value()
@@ -445,34 +546,44 @@ class MainWindow(QtGui.QWidget):
             self._midi.SendMSCGo(str(chan - startChan + 1))
             self._midiLight.activate()
 
-  def _onDmxTimer(self):
+  def _onDmxTick(self):
+    # runs on the scheduler thread, so it must not touch any widgets
     try:
       with QtCore.QMutexLocker(self._mutex):
-        self._dmx.SendUniverses(self._universeData)
-        for universe in self._universeData.iterkeys():
-          self._dmxLights[universe-1].activate()
+        written = self._dmx.SendUniverses(self._universeData)
+        self._latency.Written(written)
+      if written:
+        self._dmxWritten.emit(written)
     except Exception, e:
-      if self._dmxRetry.isChecked():
+      if self._dmxRetryEnabled:
         with QtCore.QMutexLocker(self._mutex):
           if self._dmx:
             logging.info('DMX disconnected')
             self._dmx.Close()
             self._dmx = None
             return
-        for port in serialdmx.ListPorts():
-          if port == str(self._dmxPort.currentText()):
-            dmx = serialdmx.SerialDmx(
-              port=str(self._dmxPort.currentText()),
-              set_dtr=self._dmxSetDtr.isChecked())
-            with QtCore.QMutexLocker(self._mutex):
-              self._dmx = dmx
+        if self._dmxOptions['port'] in serialdmx.ListPorts():
+          dmx = serialdmx.SerialDmx(**self._dmxOptions)
+          with QtCore.QMutexLocker(self._mutex):
+            self._dmx = dmx
       else:
-        self._dmxButton.setChecked(False)
-        msg = QtGui.QMessageBox(self)
-        msg.setWindowTitle('Error')
-        msg.setText(str(e))
-        msg.setIcon(QtGui.QMessageBox.Critical)
-        msg.exec_()
+        # no more ticks until the GUI thread has turned the output off
+        dmxScheduler = self._dmxScheduler
+        if dmxScheduler:
+          dmxScheduler.Close()
+        self._dmxFailed.emit(str(e))
+
+  def _onDmxWritten(self, universes):
+    for universe in universes:
+      self._dmxLights[universe-1].activate()
+
+  def _onDmxFailed(self, error):
+    self._dmxButton.setChecked(False)
+    msg = QtGui.QMessageBox(self)
+    msg.setWindowTitle('Error')
+    msg.setText(error)
+    msg.setIcon(QtGui.QMessageBox.Critical)
+    msg.exec_()
 
 def main():
   logging.basicConfig(stream=sys.stderr, level=logging.INFO)
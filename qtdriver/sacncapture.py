@@ -0,0 +1,278 @@
+# Records received sACN universes to a file and replays them, so that the
+# drivers can be exercised without a console on the network.
+#
+# A capture is a header followed by one record per received frame:
+#
+#   header:  Magic (8s), Version (B)
+#   record:  Time (d), Universe (H), RangeCount (B),
+#            RangeCount * (Start (H), Length (H), Levels (Length bytes))
+#
+# The first record of a universe holds all 512 levels; later ones hold only
+# the 32-channel blocks that changed, so static looks take 11 bytes a frame.
+#
+# Every recording session starts with a marker record for universe 0 with no
+# ranges, stamped with the wall clock. The records that follow are stamped with
+# the monotonic clock, so their times only compare within their session and
+# replay rebases its timing at each marker.
+
+import logging
+import mmap
+import os
+import sacn
+import scheduler
+import struct
+import sys
+import threading
+import time
+
+class CaptureError(Exception):
+  """Capture file is missing or malformed."""
+
+_HEADER = struct.Struct("!8sB")
+_MAGIC = "AVRDMXSC"
+_VERSION = 1
+_RECORD = struct.Struct("!dHB")
+_RANGE = struct.Struct("!HH")
+_SESSION = 0
+
+class SACNRecorder(object):
+  """Appends received universes to a capture file.
+
+  Record takes the same arguments as the SACNListener callback, so it can be
+  called from the callback or be the callback itself.
+  """
+
+  def __init__(self, path, universes=[1]):
+    self._store = sacn.UniverseStore(universes)
+    self._seen = set()
+    exists = os.path.exists(path) and os.path.getsize(path) > 0
+    if exists:
+      # drop any partial record left by a recorder that was killed, so that
+      # replay does not stop there or misread this session's records
+      with open(path, "r+b") as f:
+        data = f.read()
+        _CheckHeader(data[:_HEADER.size])
+        end = _HEADER.size
+        for unused_time, unused_universe, unused_ranges, end in _Records(data):
+          pass
+        if end < len(data):
+          logging.warning("Dropping %d bytes of truncated capture from %s",
+                          len(data) - end, path)
+          f.truncate(end)
+    self._file = open(path, "ab")
+    if not exists:
+      self._file.write(_HEADER.pack(_MAGIC, _VERSION))
+    self._file.write(_RECORD.pack(time.time(), _SESSION, 0))
+    self._lock = threading.Lock()
+    logging.info("Recording sACN universes %s to %s", universes, path)
+
+  def Close(self):
+    with self._lock:
+      self._file.close()
+    logging.info("Stopped recording sACN")
+
+  def Record(self, universe, channels):
+    with self._lock:
+      if universe not in self._store or self._file.closed:
+        return
+      self._store.Update(universe, channels)
+      if universe in self._seen:
+        ranges = self._store.DirtyRanges(universe)
+      else:
+        self._seen.add(universe)
+        ranges = [(0, self._store.CHANNELS)]
+      self._store.ClearDirty(universe)
+
+      levels = self._store.Get(universe)
+      write = self._file.write
+      write(_RECORD.pack(scheduler.monotonic(), universe, len(ranges)))
+      for start, end in ranges:
+        write(_RANGE.pack(start, end - start))
+        write(levels[start:end])
+
+class SACNReplayer(object):
+  """Feeds the frames of a capture file to a listener callback.
+
+  The file is memory-mapped and levels are copied straight out of the
+  mapping. Frames are replayed at their original timing, scaled by speed, or
+  as fast as possible when realtime is False. This offers the parts of the
+  SACNListener interface that the drivers use, so it can stand in for one.
+  """
+
+  def __init__(self, path, callback=None, universes=None, realtime=True,
+               speed=1.0, repeat=False):
+    self._path = path
+    self._callback = callback
+    self._realtime = realtime
+    self._speed = speed
+    self._repeat = repeat
+
+    self._file = open(path, "rb")
+    try:
+      self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError), e:
+      self._file.close()
+      raise CaptureError("Cannot map %s: %s" % (path, e))
+    _CheckHeader(self._map[:_HEADER.size])
+    self._universes = self._ScanUniverses()
+    if universes is not None:
+      self._universes = [u for u in self._universes if u in universes]
+    self._store = sacn.UniverseStore(self._universes)
+    self._frames = dict([(universe, bytearray(self._store.CHANNELS))
+                         for universe in self._universes])
+    self._receive_times = {}
+
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._Run, name="SACNReplayer")
+    self._thread.start()
+    logging.info("Replaying sACN universes %s from %s", self._universes, path)
+
+  def Close(self):
+    self._stop.set()
+    if threading.current_thread() is not self._thread:
+      self._thread.join()
+    self._map.close()
+    self._file.close()
+    logging.info("Stopped replaying %s", self._path)
+
+  def Done(self):
+    return not self._thread.is_alive()
+
+  def Universes(self):
+    return list(self._universes)
+
+  def GetChannels(self, universe=1):
+    return self._store.Get(universe)
+
+  def Snapshot(self):
+    return self._store.Snapshot()
+
+  def Version(self, universe=1):
+    return self._store.Version(universe)
+
+  def Changed(self, universe=1):
+    return self._store.IsDirty(universe)
+
+  def DirtyRanges(self, universe=1):
+    return self._store.DirtyRanges(universe)
+
+  def RejectCounts(self):
+    return {}
+
+  def ReceiveTimes(self, universe=1):
+    return self._receive_times.get(universe)
+
+  def _ScanUniverses(self):
+    universes = set()
+    for unused_timestamp, universe, unused_ranges, unused_end in _Records(
+        self._map):
+      if universe != _SESSION:
+        universes.add(universe)
+    return sorted(universes)
+
+  def _Run(self):
+    if not self._universes:
+      logging.warning("Nothing to replay in %s", self._path)
+      return
+    while not self._stop.is_set():
+      first = None
+      for timestamp, universe, ranges, unused_end in _Records(self._map):
+        if self._stop.is_set():
+          return
+        if universe == _SESSION:
+          # a new recording session: its times are not related to the last
+          first = None
+          continue
+        if universe not in self._frames:
+          continue
+        if self._realtime:
+          if first is None:
+            first = timestamp
+            start = scheduler.monotonic()
+          delay = ((timestamp - first) / self._speed -
+                   (scheduler.monotonic() - start))
+          if delay > 0 and self._stop.wait(delay):
+            return
+        received = scheduler.monotonic()
+        frame = self._frames[universe]
+        for offset_start, length, offset in ranges:
+          frame[offset_start:offset_start + length] = buffer(self._map, offset,
+                                                             length)
+        self._store.Update(universe, frame)
+        self._receive_times[universe] = (received, scheduler.monotonic())
+        if self._callback:
+          self._callback(universe, self._store.Get(universe))
+        self._store.ClearDirty(universe)
+      if not self._repeat:
+        return
+
+def _Records(data):
+  """Yields (time, universe, [(start, length, offset)], end) for every record.
+
+  Stops at a truncated or corrupt tail; end is the offset after the record.
+  """
+  size = len(data)
+  offset = _HEADER.size
+  while offset + _RECORD.size <= size:
+    timestamp, universe, range_count = _RECORD.unpack_from(data, offset)
+    offset += _RECORD.size
+    ranges = []
+    for i in xrange(range_count):
+      if offset + _RANGE.size > size:
+        return
+      start, length = _RANGE.unpack_from(data, offset)
+      offset += _RANGE.size
+      if (offset + length > size or
+          start + length > sacn.UniverseStore.CHANNELS):
+        # a truncated or corrupt tail, e.g. from a recorder that was killed
+        return
+      ranges.append((start, length, offset))
+      offset += length
+    yield timestamp, universe, ranges, offset
+
+def _CheckHeader(header):
+  if len(header) < _HEADER.size:
+    raise CaptureError("Capture file too short")
+  magic, version = _HEADER.unpack(header)
+  if magic != _MAGIC:
+    raise CaptureError("Not an sACN capture file")
+  if version != _VERSION:
+    raise CaptureError("Unsupported capture version %d" % version)
+
+if __name__ == "__main__":
+  import argparse
+  logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+  parser = argparse.ArgumentParser()
+  parser.add_argument("command", choices=["record", "replay"])
+  parser.add_argument("path")
+  parser.add_argument("--universes", type=int, nargs="+", default=[1,2,3,4])
+  parser.add_argument("--fast", action="store_true",
+                      help="replay as fast as possible")
+  args = parser.parse_args()
+
+  if args.command == "record":
+    recorder = SACNRecorder(args.path, universes=args.universes)
+    sacn_listener = sacn.SACNListener(universes=args.universes,
+                                      callback=recorder.Record,
+                                      coalesce=True)
+    try:
+      while True:
+        time.sleep(1)
+    finally:
+      sacn_listener.Close()
+      recorder.Close()
+  else:
+    frames = {}
+    def Callback(universe, channels):
+      frames[universe] = frames.get(universe, 0) + 1
+    start = time.time()
+    replayer = SACNReplayer(args.path, callback=Callback,
+                            realtime=not args.fast)
+    try:
+      while not replayer.Done():
+        time.sleep(0.1)
+    finally:
+      replayer.Close()
+    elapsed = time.time() - start
+    logging.info("Replayed %d frames in %.2f s: %s",
+                 sum(frames.values()), elapsed, frames)
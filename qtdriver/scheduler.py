@@ -0,0 +1,126 @@
+import ctypes
+import ctypes.util
+import logging
+import platform
+import threading
+import time
+
+def _MonotonicClock():
+  """Returns a function giving seconds from a clock that never goes back."""
+  if hasattr(time, "monotonic"):
+    return time.monotonic
+  system = platform.system()
+  if system == "Windows":
+    # time.clock is QueryPerformanceCounter on Windows, so wall time there
+    return time.clock
+  if system == "Linux":
+    class timespec(ctypes.Structure):
+      _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+    CLOCK_MONOTONIC = 1
+    try:
+      librt = ctypes.CDLL(ctypes.util.find_library("rt") or "libc.so.6")
+      clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+      clock_gettime = None
+    if clock_gettime:
+      clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+      def Monotonic():
+        t = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+      return Monotonic
+  logging.warning("No monotonic clock, frame timing follows the wall clock")
+  return time.time
+
+monotonic = _MonotonicClock()
+
+class FrameScheduler(object):
+  """Calls a function at a fixed rate from one long-lived thread.
+
+  Ticks are due at absolute deadlines on a monotonic clock, start + n / rate,
+  so the time the callback takes and late wakeups do not add up to drift.
+  When the callback runs past the next deadline, the missed ticks are
+  dropped rather than run back to back, and counted as overruns.
+  """
+
+  def __init__(self, callback, rate, name="FrameScheduler"):
+    assert rate > 0
+    self._callback = callback
+    self._period = 1.0 / rate
+    self._lock = threading.Lock()
+    self.ResetStats()
+
+    self._active = True
+    self._thread = threading.Thread(target=self._Run, name=name)
+    self._thread.start()
+
+  def Close(self):
+    """Stops ticking. May be called from the callback itself."""
+    self._active = False
+    if threading.current_thread() is not self._thread:
+      self._thread.join()
+
+  def Rate(self):
+    return 1.0 / self._period
+
+  def Stats(self, reset=False):
+    """Returns the timing since the last reset, in milliseconds.
+
+    jitter is how late the callback started after its deadline, busy is how
+    long it ran, and overruns counts the ticks that were dropped because the
+    previous one was still running at their deadline.
+    """
+    with self._lock:
+      ticks = self._ticks
+      stats = {
+        "ticks": ticks,
+        "overruns": self._overruns,
+        "jitter_avg_ms": round(self._jitter_total / ticks * 1000, 2)
+                         if ticks else 0.0,
+        "jitter_max_ms": round(self._jitter_max * 1000, 2),
+        "busy_max_ms": round(self._busy_max * 1000, 2),
+      }
+      if reset:
+        self._ResetStats()
+    return stats
+
+  def ResetStats(self):
+    with self._lock:
+      self._ResetStats()
+
+  def _ResetStats(self):
+    self._ticks = 0
+    self._overruns = 0
+    self._jitter_total = 0.0
+    self._jitter_max = 0.0
+    self._busy_max = 0.0
+
+  def _Run(self):
+    period = self._period
+    deadline = monotonic() + period
+    while self._active:
+      remaining = deadline - monotonic()
+      if remaining > 0:
+        time.sleep(remaining)
+        continue
+
+      due = deadline
+      start = monotonic()
+      try:
+        self._callback()
+      except Exception:
+        logging.exception("Frame callback failed")
+      end = monotonic()
+
+      deadline += period
+      missed = 0
+      if end > deadline:
+        missed = int((end - deadline) / period) + 1
+        deadline += missed * period
+      with self._lock:
+        self._ticks += 1
+        self._overruns += missed
+        jitter = start - due
+        self._jitter_total += jitter
+        self._jitter_max = max(self._jitter_max, jitter)
+        self._busy_max = max(self._busy_max, end - start)